@@ -70,6 +70,63 @@ def test(verbose=False, coverage=False):
         else:
             run(f". {dir}/bin/activate && brbn-self-test {args}", shell=True)
 
+@command
+def bench(iterations=100_000):
+    """
+    Measure the time and allocations of per-request Request objects
+    """
+
+    import sys
+    import timeit
+    import tracemalloc
+
+    sys.path.insert(0, "src")
+
+    from brbn import Request, Server
+
+    server = Server()
+    headers = [(b"host", b"localhost:8080"), (b"accept", b"*/*"), (b"if-none-match", b'"abc"')]
+
+    def make_scope():
+        return {
+            "type": "http",
+            "method": "GET",
+            "path": "/files/alpha.txt",
+            "query_string": b"",
+            "headers": headers,
+            "brbn.path_params": {"subpath": "/alpha.txt"},
+        }
+
+    scopes = [make_scope() for i in range(iterations)]
+
+    def construct():
+        for scope in scopes:
+            Request(server, scope, None, None)
+
+    def construct_and_use():
+        for scope in scopes:
+            request = Request(server, scope, None, None)
+            request.require("subpath")
+            request.get_header_bytes(b"if-none-match")
+
+    for name, function in (("construct", construct), ("construct and use", construct_and_use)):
+        seconds = min(timeit.repeat(function, number=1, repeat=5))
+        print(f"{name}: {seconds / iterations * 1e9:.0f} ns per request")
+
+    tracemalloc.start()
+
+    before = tracemalloc.take_snapshot()
+    requests = [Request(server, scope, None, None) for scope in scopes]
+    after = tracemalloc.take_snapshot()
+
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, "filename")
+    blocks = sum(x.count_diff for x in stats) - 1 # Minus the list
+    size = sum(x.size_diff for x in stats) - sys.getsizeof(requests)
+
+    print(f"retained: {blocks / iterations:.1f} blocks, {size / iterations:.0f} bytes per request")
+
 @command
 def install():
     build()
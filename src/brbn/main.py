@@ -19,28 +19,55 @@
 
 import argparse as _argparse
 import asyncio as _asyncio
+import base64 as _base64
+import functools as _functools
+import gzip as _gzip
+import hmac as _hmac
 import importlib as _importlib
 import inspect as _inspect
 import json as _json
 import logging as _logging
 import os as _os
+import pathlib as _pathlib
 import re as _re
 import struct as _struct
+import tempfile as _tempfile
 import traceback as _traceback
+import types as _types
 import urllib as _urllib
+import uuid as _uuid
 import uvicorn as _uvicorn
+import zlib as _zlib
 
 _log = _logging.getLogger("brbn.main")
 
 class Server:
     def __init__(self):
-        self.csp = "default-src 'self'"
+        self._csp = "default-src 'self'"
+        self._default_headers = None # Encoded on first use
+        self.json_codec = _default_json_codec
+        self.compress_responses = True
+        self.compression_min_size = 1024 # In bytes.  Streamed responses are always compressed.
+        self.cookie_signer = None
+        self.watch_disconnects = False # Cancel handlers when the client goes away.  Costs a task per request.
+        self.json_executor = None # A ProcessPoolExecutor for large JSON.  None means no offloading.
+        self.json_offload_size = 1024 * 1024 # In bytes, for parsing
+        self.json_offload_items = 10_000 # In items two levels deep, for responses
+        self.max_body_size = None
+        self.body_spool_size = 1024 * 1024 # Larger bodies go to disk in get_body_file()
+        self.count_route_hits = False
+        self.reorder_routes = False # Requires count_route_hits
+        self.reorder_interval = 10_000
         self.started = _asyncio.Event()
         self.stopped = _asyncio.Event()
 
         self._startup_coros = list()
         self._shutdown_coros = list()
-        self._routes = list()
+        self._router = _Router()
+        self._routers_by_host = dict()
+        self._routers_by_domain = dict() # For wildcard hosts such as *.example.com
+        self._mounted_servers = list()
+        self._frozen = False
 
         self._task = None
         self._loop = None
@@ -54,14 +81,130 @@ class Server:
     def add_shutdown_task(self, coro):
         self._shutdown_coros.append(coro)
 
-    def add_route(self, path, resource):
+    def add_route(self, path, resource, methods=None, method=None, host=None):
         assert path.startswith("/"), path
         assert path == "/" or not path.endswith("/"), path
+        assert host is None or host == host.lower() and ":" not in host, host
 
-        route = _Route(path, resource)
-        self._routes.append(route)
+        if methods is None:
+            methods = resource.methods
 
-        _log.info(f"Route: {route}")
+        if method is not None:
+            methods = (method,)
+
+        route = self._get_host_router(host).add_route(path, resource, methods)
+        resource._encode_headers()
+
+        _log.info(f"Route: {_describe_route(route, host)}")
+
+    def mount(self, prefix, server, host=None):
+        assert prefix.startswith("/") and not prefix.endswith("/"), prefix
+        assert "{" not in prefix and not prefix.endswith("/*"), prefix
+        assert server is not self, server
+
+        route = self._get_host_router(host).add_mount(prefix, server)
+        self._mounted_servers.append(server)
+
+        _log.info(f"Mount: {_describe_route(route, host)}")
+
+    # A new host would get a new router, so no host is accepted once frozen
+    def _get_host_router(self, host):
+        if self._frozen:
+            raise RouteError(f"Cannot add routes for host {host}: The routes are frozen")
+
+        if host is None:
+            return self._router
+
+        if host.startswith("*."):
+            return self._routers_by_domain.setdefault(host[2:], _Router())
+
+        return self._routers_by_host.setdefault(host, _Router())
+
+    def get_route_hits(self):
+        hits = dict()
+
+        for host, router in self._get_host_routers():
+            for route in router.routes:
+                hits[_describe_route(route, host)] = route.hits
+
+        return hits
+
+    def _get_host_routers(self):
+        yield None, self._router
+        yield from self._routers_by_host.items()
+        yield from ((f"*.{x}", y) for x, y in self._routers_by_domain.items())
+
+    # Mounts can form a cycle, so a server already frozen is skipped
+    def freeze(self):
+        if self._frozen:
+            return
+
+        for _, router in self._get_host_routers():
+            router.freeze()
+
+        self._frozen = True
+
+        for server in self._mounted_servers:
+            server.freeze()
+
+    # Requests for a host with its own routes use only those routes.
+    # Requests for any other host use the routes added without a host.
+    def _get_router(self, scope):
+        if not self._routers_by_host and not self._routers_by_domain:
+            return self._router
+
+        for name, value in scope["headers"]:
+            if name == b"host":
+                host = value.decode("latin-1").lower()
+                break
+        else:
+            return self._router
+
+        if host.startswith("["):
+            host = host[:host.find("]") + 1]
+        else:
+            host = host.partition(":")[0]
+
+        router = self._routers_by_host.get(host)
+
+        if router is not None:
+            return router
+
+        if self._routers_by_domain:
+            domain = host.partition(".")[2]
+
+            while domain:
+                router = self._routers_by_domain.get(domain)
+
+                if router is not None:
+                    return router
+
+                domain = domain.partition(".")[2]
+
+        return self._router
+
+    async def _run_json_task(self, function, arg):
+        return await _asyncio.get_running_loop().run_in_executor(self.json_executor, function, arg)
+
+    @property
+    def csp(self):
+        return self._csp
+
+    @csp.setter
+    def csp(self, value):
+        self._csp = value
+        self._default_headers = None
+
+    # Returns a shared list.  Don't modify it.
+    def _get_default_headers(self):
+        if self._default_headers is None:
+            self._default_headers = [
+                (b"content-security-policy", self.csp.encode("utf-8")),
+                (b"referrer-policy", b"no-referrer"),
+                (b"x-content-type-options", b"nosniff"),
+            ]
+
+        return self._default_headers
 
     def run(self, host="", port=8080):
         _asyncio.run(self._run(host=host, port=port))
@@ -118,17 +261,23 @@ class Server:
             assert False, type # pragma: nocover
 
     async def _handle_http_event(self, scope, receive, send):
-        path = scope["path"]
+        router = self._get_router(scope)
+        match = router.find_route(scope["path"], scope["method"])
 
-        for route in self._routes:
-            match = route.regex.fullmatch(path)
+        if match is not None:
+            route, params = match
 
-            if match is not None:
-                scope["brbn.path_params"] = match.groupdict()
-                await route.resource(self, scope, receive, send)
-                return
+            if self.count_route_hits:
+                router.count_hit(route, self.reorder_interval if self.reorder_routes else None)
 
-        await Request(self, scope, receive, send).respond(404, "Not found")
+            scope["brbn.path_params"] = params
+            await route.resource(self, scope, receive, send)
+            return
+
+        # No Request needed.  The headers are copied, since middleware
+        # may modify them in place.
+        await send({"type": "http.response.start", "status": 404, "headers": list(self._get_default_headers())})
+        await send({"type": "http.response.body", "body": b"Not found", "more_body": False})
 
     async def _handle_lifespan_event(self, scope, receive, send):
         while True:
@@ -138,6 +287,12 @@ class Server:
             _log.debug("Receiving message %s", message)
 
             if type == "lifespan.startup":
+                try:
+                    self.freeze()
+                except RouteError as e:
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+
                 for coro in self._startup_coros:
                     _asyncio.get_event_loop().create_task(coro)
 
@@ -151,6 +306,12 @@ class Server:
             else:
                 assert False, type # pragma: nocover
 
+def _describe_route(route, host):
+    if host is None:
+        return str(route)
+
+    return f"{route} (host {host})"
+
 class _UvicornServer(_uvicorn.Server):
     def __init__(self, config, started, stopped):
         super().__init__(config=config)
@@ -166,22 +327,552 @@ class _UvicornServer(_uvicorn.Server):
         self._brbn_stopped.set()
 
 class _Route:
-    def __init__(self, path, resource):
+    def __init__(self, path, resource, methods, index):
         self.path = path
         self.resource = resource
+        self.methods = tuple(methods)
+        self.index = index
+        self.hits = 0
+
+        pattern = path
+        self.wildcard = pattern.endswith("/*")
+
+        if self.wildcard:
+            pattern = pattern[:-2]
+
+        self.segments = pattern[1:].split("/") if pattern else []
+        self.static = not self.wildcard and "{" not in path
+
+    def __repr__(self):
+        if not self.methods:
+            return f"{self.path} -> {self.resource}"
+
+        return f"{self.path} ({', '.join(self.methods)}) -> {self.resource}"
+
+# Ranks a method-not-allowed fallback after every real route
+_FALLBACK_INDEX = 1 << 48
+
+# The routes for one path pattern, keyed by method
+class _Endpoint:
+    def __init__(self, path, index):
+        self.path = path
+        self.routes_by_method = dict()
+        self.fallback = None
+        self.index = index
+
+    def add_route(self, route, methods):
+        for method in methods:
+            self.routes_by_method.setdefault(method, route)
+
+        resource = _MethodNotAllowedResource(self.routes_by_method)
+        self.fallback = _Route(self.path, resource, (), _FALLBACK_INDEX + self.index)
+
+    def get_route(self, method):
+        return self.routes_by_method.get(method, self.fallback)
+
+class _MethodNotAllowedResource:
+    def __init__(self, methods):
+        self.methods = tuple(methods)
+        self.allow_header = (b"allow", ", ".join(methods).encode("utf-8"))
+        self.headers = [self.allow_header, (b"content-type", b"text/plain;charset=UTF-8")]
+        self.body_message = {
+            "type": "http.response.body",
+            "body": b"Method not allowed",
+            "more_body": False,
+        }
+
+    def __repr__(self):
+        return _format_repr(self, self.allow_header[1].decode("utf-8"))
+
+    async def __call__(self, server, scope, receive, send):
+        headers = server._get_default_headers() + self.headers
+
+        await send({"type": "http.response.start", "status": 405, "headers": headers})
+        await send(self.body_message)
 
-        regex = _re.sub(r"/\*$", r"(?P<subpath>.*)", path)
-        regex = _re.sub(r"{(\w+)}", r"(?P<\1>[^/]+)", regex)
+# Placeholder types for {name:type}.  The pattern validates a value
+# during matching, and the function converts it.
+_path_param_types = {
+    "str": (r"[^/]+", None),
+    "int": (r"[0-9]+", int),
+    "uuid": (r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}", _uuid.UUID),
+}
+
+# One segment of a route path containing {name}, {name:type}, or
+# {name:re:pattern} placeholders
+class _PathSegment:
+    def __init__(self, text):
+        self.text = text
+        self.parts = _parse_path_segment(text) # Literal strings and (name, pattern, convert) tuples
+        self.params = [x for x in self.parts if isinstance(x, tuple)]
+        self.name = None
+
+        # The whole segment is a single untyped placeholder
+        if self.parts == ["", self.params[0], ""] and self.params[0][1:] == _path_param_types["str"]:
+            self.name = self.params[0][0]
+
+        self.regex = _re.compile(self.get_pattern())
+
+    def get_pattern(self, prefix=""):
+        return "".join(_re.escape(x) if isinstance(x, str) else f"(?P<{prefix}{x[0]}>{x[1]})" for x in self.parts)
+
+    def convert(self, match, prefix=""):
+        values = dict()
+
+        for name, _, convert in self.params:
+            value = match.group(prefix + name)
+            values[name] = value if convert is None else convert(value)
+
+        return values
 
-        self.regex = _re.compile(regex)
+    def match(self, value):
+        if self.name is not None:
+            return {self.name: value} if value else None
+
+        match = self.regex.fullmatch(value)
+
+        if match is not None:
+            return self.convert(match)
+
+def _parse_path_segment(text):
+    parts = list()
+    pos = 0
+
+    while True:
+        start = text.find("{", pos)
+
+        if start == -1:
+            parts.append(text[pos:])
+            return parts
+
+        parts.append(text[pos:start])
+        depth = 0
+
+        # Find the matching brace, allowing for braces in a regex
+        for end in range(start, len(text)):
+            if text[end] == "{":
+                depth += 1
+            elif text[end] == "}":
+                depth -= 1
+
+                if depth == 0:
+                    break
+        else:
+            raise RouteError(f"Unbalanced braces in route segment: {text}")
+
+        name, _, type = text[start + 1:end].partition(":")
+
+        if not name.isidentifier():
+            raise RouteError(f"Illegal parameter name in route segment: {text}")
+
+        if type.startswith("re:"):
+            parts.append((name, f"(?:{type[3:]})", None))
+        elif type in _path_param_types or type == "":
+            parts.append((name, *_path_param_types[type or "str"]))
+        else:
+            raise RouteError(f"Unknown parameter type in route segment: {text}")
+
+        pos = end + 1
+
+# Hands requests under a prefix to another server, which routes the
+# rest of the path with its own router
+class _MountResource:
+    def __init__(self, prefix, server):
+        self.prefix = prefix
+        self.server = server
 
     def __repr__(self):
-        return f"{self.path} -> {self.resource}"
+        return _format_repr(self, self.server)
+
+    async def __call__(self, server, scope, receive, send):
+        scope = dict(scope)
+        scope["path"] = scope["path"][len(self.prefix):] or "/"
+        scope["root_path"] = scope.get("root_path", "") + self.prefix
+
+        await self.server._handle_http_event(scope, receive, send)
+
+class _RouteNode:
+    def __init__(self):
+        self.static_children = dict()
+        self.dynamic_children = list() # [(_PathSegment, _RouteNode)]
+        self.endpoint = None
+        self.wildcard_endpoint = None
+        self.mount_route = None
+        self.min_index = None # The earliest route at or below this node
+
+        # Set by compile()
+        self.regex = None
+        self.group_names = None
+        self.exclusive = False
+
+    def get_child(self, text):
+        if "{" not in text:
+            return self.static_children.setdefault(text, _RouteNode())
+
+        for segment, child in self.dynamic_children:
+            if segment.text == text:
+                return child
+
+        child = _RouteNode()
+        self.dynamic_children.append((_PathSegment(text), child))
+
+        return child
+
+    # Combine the dynamic children into one regex.  When no two of
+    # them can match the same text, the regex is a plain alternation
+    # that stops at the first match.  Otherwise each child gets an
+    # optional lookahead with its own named group, so a single match
+    # call reports every child that matches.
+    def compile(self):
+        for child in self.static_children.values():
+            child.compile()
+
+        for _, child in self.dynamic_children:
+            child.compile()
+
+        self.exclusive = not any(_segments_overlap(x[0], y[0])
+                                 for i, x in enumerate(self.dynamic_children)
+                                 for y in self.dynamic_children[i + 1:])
+
+        self._compile_regex()
+
+    def _compile_regex(self):
+        if not self.dynamic_children:
+            return
+
+        self.group_names = [f"_{i}" for i in range(len(self.dynamic_children))]
+        patterns = [f"(?P<{x}>{y.get_pattern(f'{x}_')})" for x, (y, _) in zip(self.group_names, self.dynamic_children)]
+
+        if self.exclusive:
+            self.regex = _re.compile("|".join(patterns))
+        else:
+            self.regex = _re.compile("".join(rf"(?={x}\Z)?" for x in patterns))
+
+    # Put the most used dynamic children first where that cannot
+    # change which route matches.  Returns the hits at or below this
+    # node.
+    def reorder(self):
+        hits = sum(x.hits for x in self._get_routes())
+        hits += sum(x.reorder() for x in self.static_children.values())
+
+        child_hits = {id(x): x.reorder() for _, x in self.dynamic_children}
+        hits += sum(child_hits.values())
+
+        if self.exclusive and len(self.dynamic_children) > 1:
+            self.dynamic_children.sort(key=lambda x: child_hits[id(x[1])], reverse=True)
+            self._compile_regex()
+
+        return hits
+
+    def _get_routes(self):
+        for endpoint in (self.endpoint, self.wildcard_endpoint):
+            if endpoint is not None:
+                yield from set(endpoint.routes_by_method.values())
+
+        if self.mount_route is not None:
+            yield self.mount_route
+
+    def match_dynamic_children(self, value):
+        if self.regex is None:
+            for segment, child in self.dynamic_children:
+                values = segment.match(value)
+
+                if values is not None:
+                    yield child, values
+
+            return
+
+        if self.exclusive:
+            match = self.regex.fullmatch(value)
+
+            if match is not None:
+                group_name = match.lastgroup
+                segment, child = self.dynamic_children[int(group_name[1:])]
+
+                if segment.name is not None:
+                    yield child, {segment.name: value}
+                else:
+                    yield child, segment.convert(match, f"{group_name}_")
+
+            return
+
+        match = self.regex.match(value)
+
+        for group_name, (segment, child) in zip(self.group_names, self.dynamic_children):
+            if match.group(group_name) is None:
+                continue
+
+            if segment.name is not None:
+                yield child, {segment.name: value}
+            else:
+                yield child, segment.convert(match, f"{group_name}_")
+
+# Whether two segments can match the same text.  It errs toward yes.
+# Only different literal text at either end, or an int against a
+# uuid, rules out an overlap.
+def _segments_overlap(a, b):
+    if not (a.parts[0].startswith(b.parts[0]) or b.parts[0].startswith(a.parts[0])):
+        return False
+
+    if not (a.parts[-1].endswith(b.parts[-1]) or b.parts[-1].endswith(a.parts[-1])):
+        return False
+
+    if len(a.parts) == len(b.parts) == 3 and a.parts[0] == b.parts[0] and a.parts[2] == b.parts[2]:
+        types = {a.parts[1][1:], b.parts[1][1:]}
+
+        if types == {_path_param_types["int"], _path_param_types["uuid"]}:
+            return False
+
+    return True
+
+# Routes with no parameters or wildcard go in a dict keyed by the
+# full path.  The rest go in a segment tree, where lookup cost follows
+# the depth of the request path, not the number of routes.  When more
+# than one route matches the path and method, the earliest registered
+# one wins.  When routes match the path but not the method, a
+# method-not-allowed fallback answers, allowing the methods of every
+# route that matches the path.
+class _Router:
+    def __init__(self):
+        self.routes = list()
+        self.frozen = False
+        self.hits = 0
+        self._static_endpoints = dict()
+        self._root = _RouteNode()
+        self._fallback_resources = dict() # By allowed methods
+
+    def add_route(self, path, resource, methods):
+        if self.frozen:
+            raise RouteError(f"Cannot add route {path}: The routes are frozen")
+
+        route = _Route(path, resource, methods, len(self.routes))
+        self.routes.append(route)
+
+        if route.static:
+            # A method already claimed by an earlier pattern route can
+            # never reach this route, so it stays out of the fast path
+            methods = [x for x in route.methods if not self._has_route(self._root, route.segments, x)]
+
+            if methods:
+                if path not in self._static_endpoints:
+                    self._static_endpoints[path] = _Endpoint(path, route.index)
+
+                self._static_endpoints[path].add_route(route, methods)
+
+            return route
+
+        node = self._get_node(route)
+
+        if route.wildcard:
+            if node.wildcard_endpoint is None:
+                node.wildcard_endpoint = _Endpoint(path, route.index)
+
+            node.wildcard_endpoint.add_route(route, route.methods)
+        else:
+            if node.endpoint is None:
+                node.endpoint = _Endpoint(path, route.index)
+
+            node.endpoint.add_route(route, route.methods)
+
+        return route
+
+    def add_mount(self, prefix, server):
+        if self.frozen:
+            raise RouteError(f"Cannot add mount {prefix}: The routes are frozen")
+
+        route = _Route(f"{prefix}/*", _MountResource(prefix, server), (), len(self.routes))
+        self.routes.append(route)
+
+        node = self._get_node(route)
+
+        if node.mount_route is None:
+            node.mount_route = route
+
+        return route
+
+    def _get_node(self, route):
+        node = self._root
+
+        for text in [None] + route.segments:
+            if text is not None:
+                node = node.get_child(text)
+
+            if node.min_index is None:
+                node.min_index = route.index
+
+        return node
+
+    def freeze(self):
+        if self.frozen:
+            return
+
+        errors = [f"Route {x} is shadowed by route {y} for method {z}" for x, y, z in self._find_shadowed_routes()]
+
+        if errors:
+            raise RouteError("; ".join(errors))
+
+        self._root.compile()
+        self.frozen = True
+
+    # A route is shadowed for a method when an earlier route matches
+    # every path it does.  Each parameter is probed with its own
+    # placeholder text, which only a parameter (never a literal) on
+    # the other side can match.  Typed parameters rarely match their
+    # own placeholder text, so routes with the same pattern apart from
+    # parameter names are compared directly.
+    def _find_shadowed_routes(self):
+        routes_by_shape = dict()
+
+        for route in self.routes:
+            probes = [route.segments]
+
+            if route.wildcard:
+                probes += [route.segments + ["{*}"], route.segments + ["{*}", "{*}"]]
+
+            # The pattern with parameter names removed
+            shape = [tuple(x if isinstance(x, str) else x[1] for x in _parse_path_segment(y)) for y in route.segments]
+            shape = (tuple(shape), route.wildcard)
+
+            for method in route.methods:
+                earlier = routes_by_shape.setdefault((shape, method), route)
+
+                if earlier is not route:
+                    yield route, earlier, method
+                    continue
+
+                for segments in probes:
+                    match = self._find_route(segments, method)
+
+                    if match is None or match[0].index >= route.index:
+                        break
+
+                    earlier = match[0]
+                else:
+                    yield route, earlier, method
+
+    def count_hit(self, route, reorder_interval=None):
+        route.hits += 1
+        self.hits += 1
+
+        if reorder_interval is not None and self.frozen and self.hits % reorder_interval == 0:
+            self._root.reorder()
+
+    def find_route(self, path, method):
+        endpoint = self._static_endpoints.get(path)
+
+        if endpoint is None:
+            match = self._find(self._root, path[1:].split("/"), 0, dict(), method)
+        else:
+            route = endpoint.routes_by_method.get(method)
+
+            if route is not None:
+                return route, dict()
+
+            match = self._find(self._root, path[1:].split("/"), 0, dict(), method)
+            match = _earliest((endpoint.fallback, dict()), match)
+
+        if match is not None and match[0].index >= _FALLBACK_INDEX:
+            return self._get_fallback(path, match), match[1]
+
+        return match
+
+    # The earliest endpoint's fallback allows only its own methods.
+    # When other routes also match the path, build one that allows
+    # theirs too.
+    def _get_fallback(self, path, match):
+        fallback = match[0]
+        methods = dict()
+        endpoint = self._static_endpoints.get(path)
+
+        if endpoint is not None:
+            methods.update(endpoint.routes_by_method)
+
+        self._collect_methods(self._root, path[1:].split("/"), 0, methods)
+        methods = tuple(methods)
+
+        if methods == tuple(fallback.resource.methods):
+            return fallback
+
+        resource = self._fallback_resources.get(methods)
+
+        if resource is None:
+            resource = self._fallback_resources[methods] = _MethodNotAllowedResource(methods)
+
+        return _Route(fallback.path, resource, (), fallback.index)
+
+    def _collect_methods(self, node, segments, pos, methods):
+        if node.wildcard_endpoint is not None:
+            methods.update(node.wildcard_endpoint.routes_by_method)
+
+        if pos == len(segments):
+            if node.endpoint is not None:
+                methods.update(node.endpoint.routes_by_method)
+
+            return
+
+        child = node.static_children.get(segments[pos])
+
+        if child is not None:
+            self._collect_methods(child, segments, pos + 1, methods)
+
+        for child, _ in node.match_dynamic_children(segments[pos]):
+            self._collect_methods(child, segments, pos + 1, methods)
+
+    def _find_route(self, segments, method):
+        return self.find_route("/" + "/".join(segments), method)
+
+    def _has_route(self, node, segments, method):
+        match = self._find(node, segments, 0, dict(), method)
+        return match is not None and match[0].index < _FALLBACK_INDEX
+
+    def _find(self, node, segments, pos, params, method):
+        best = None
+
+        if node.wildcard_endpoint is not None:
+            subpath = "/" + "/".join(segments[pos:]) if pos < len(segments) else ""
+            best = node.wildcard_endpoint.get_route(method), {**params, "subpath": subpath}
+
+        if node.mount_route is not None:
+            best = _earliest(best, (node.mount_route, params))
+
+        if pos == len(segments):
+            if node.endpoint is not None:
+                best = _earliest(best, (node.endpoint.get_route(method), params))
+
+            return best
+
+        segment = segments[pos]
+        child = node.static_children.get(segment)
+
+        if child is not None:
+            best = _earliest(best, self._find(child, segments, pos + 1, params, method))
+
+        for child, values in node.match_dynamic_children(segment):
+            # Skip subtrees that cannot hold an earlier route
+            if best is not None and child.min_index > best[0].index:
+                continue
+
+            best = _earliest(best, self._find(child, segments, pos + 1, {**params, **values}, method))
+
+        return best
+
+def _earliest(a, b):
+    if a is None:
+        return b
+
+    if b is None:
+        return a
+
+    return a if a[0].index <= b[0].index else b
 
 class Resource:
-    def __init__(self, app=None, methods=("GET", "HEAD", "POST"), method=None):
+    def __init__(self, app=None, methods=("GET", "HEAD", "POST"), method=None, max_body_size=None, headers=None):
         self.app = app
         self.methods = methods
+        self.max_body_size = max_body_size # Overrides the server setting
+        self.headers = headers # Extra response headers, as a dict of str
+
+        self._encoded_headers = None
 
         if method is not None:
             self.methods = (method,)
@@ -189,43 +880,77 @@ class Resource:
     def __repr__(self):
         return _format_repr(self)
 
+    # Called when the resource is added to a route, so responses need
+    # no encoding of their own
+    def _encode_headers(self):
+        self._encoded_headers = [(x.lower().encode("latin-1"), y.encode("latin-1"))
+                                 for x, y in (self.headers or dict()).items()]
+
     async def __call__(self, server, scope, receive, send):
         request = Request(server, scope, receive, send)
 
+        if self._encoded_headers is None:
+            self._encode_headers()
+
+        request._extra_headers = self._encoded_headers
+
+        if self.max_body_size is not None:
+            request.max_body_size = self.max_body_size
+
+        # Calling receive() makes the server send 100 Continue, so a
+        # request expecting one isn't watched.  The handler may still
+        # reject the body based on its headers.
+        expect = request.get_header_bytes(b"expect")
+
+        if server.watch_disconnects and (expect is None or expect.lower() != b"100-continue"):
+            await request._run_watched(self._handle_request(request))
+        else:
+            await self._handle_request(request)
+
+    async def _handle_request(self, request):
         try:
             await self.handle(request)
+        except ClientDisconnected:
+            _log.debug("Client disconnected: %s", request)
+        except PayloadTooLargeError as e:
+            await request._respond_error(413, str(e))
         except BadRequestError as e:
-            await request.respond(400, str(e))
+            await request._respond_error(400, str(e))
         except Exception as e:
             _log.exception(e)
             trace = _traceback.format_exc()
             print(111, trace) # Need this in debug mode XXX
-            await request.respond(500, trace)
+            await request._respond_error(500, trace)
 
+    # The router has already checked the method against the route
     async def handle(self, request):
-        if request.method not in self.methods:
-            await request.respond(400, "Bad request: Illegal method")
-            return
-
         entity = await self.process(request)
         server_etag = await self.get_etag(request, entity)
 
         if server_etag is not None:
             server_etag = f'"{server_etag}"'
-            client_etag = request.get_header("if-none-match")
+            client_etag = request.get_header_bytes(b"if-none-match")
 
-            if client_etag == server_etag:
+            # Compressed responses carry weak tags, so compare weakly
+            if client_etag is not None and client_etag.removeprefix(b"W/") == server_etag.encode("utf-8"):
                 await request.respond(304)
                 return
 
+        content_encoding = await self.get_content_encoding(request, entity)
+
         if request.method == "HEAD":
-            await request.respond(200, etag=server_etag)
+            await request.respond(200, etag=server_etag, content_encoding=content_encoding)
             return
 
         content = await self.render(request, entity)
         content_type = await self.get_content_type(request, entity)
 
-        await request.respond(200, content, content_type=content_type, etag=server_etag)
+        if content is not None and not isinstance(content, (bytes, str, _os.PathLike)) and not _is_stream(content):
+            await request.respond_json(200, content, content_type=content_type, etag=server_etag)
+            return
+
+        await request.respond(200, content, content_type=content_type, etag=server_etag,
+                              content_encoding=content_encoding)
 
     async def process(self, request):
         return None
@@ -236,21 +961,42 @@ class Resource:
     async def get_content_type(self, request, entity):
         return None
 
+    # Return a coding name if render returns content that is already
+    # encoded.  None means the server may compress it on the fly.
+    async def get_content_encoding(self, request, entity):
+        return None
+
     async def render(self, request, entity):
         return None
 
+# One is made for every request, so it has slots instead of a dict
+# and defers all parsing to first use
 class Request:
+    __slots__ = ("_server", "_scope", "_receive", "_send", "_path_params", "_query_params", "_headers",
+                 "_cookies", "_body", "_streamed", "_watched", "_pending_message", "_message_waiter",
+                 "_extra_headers", "_response_started", "_response_complete", "disconnected", "max_body_size")
+
     def __init__(self, server, scope, receive, send):
         self._server = server
         self._scope = scope
         self._receive = receive
         self._send = send
-        self._params = scope.get("brbn.path_params", dict())
-
-        query_string = scope["query_string"].decode("utf-8")
-
-        for name, value in _urllib.parse.parse_qsl(query_string):
-            self._params[name] = value
+        self._path_params = scope.get("brbn.path_params", _no_params)
+        self._query_params = None # Parsed on first use
+        self._headers = None # Indexed on first use
+        self._cookies = None # Parsed on first use
+        self._body = None
+        self._streamed = False
+        self._watched = False # Set while a disconnect watcher owns receive()
+        self._pending_message = None # A body message from the watcher
+        self._message_waiter = None # A future for whichever side is waiting
+        self._extra_headers = _no_headers # Set by the resource
+        self._response_started = False # Set once the start message is sent
+        self._response_complete = False # Set once the last body message is sent
+
+        self.disconnected = False
+
+        self.max_body_size = server.max_body_size
 
     def __repr__(self):
         return _format_repr(self, self.method, self.path)
@@ -263,58 +1009,384 @@ class Request:
     def path(self):
         return self._scope["path"]
 
+    @property
+    def path_params(self):
+        return self._path_params
+
+    # Path parameters come first.  A query parameter given more than
+    # once yields its last value.
     def get(self, name, default=None):
-        return self._params.get(name, default)
+        try:
+            return self._path_params[name]
+        except KeyError:
+            pass
 
-    def require(self, name):
+        values = self._get_query_params().get(name)
+
+        if values is None:
+            return default
+
+        return values[-1]
+
+    def getall(self, name):
         try:
-            return self._params[name]
+            return [self._path_params[name]]
         except KeyError:
+            pass
+
+        return list(self._get_query_params().get(name, ()))
+
+    def require(self, name):
+        value = self.get(name, _missing)
+
+        if value is _missing:
             raise BadRequestError(f"Required parameter not found: {name}")
 
+        return value
+
+    def _get_query_params(self):
+        if self._query_params is None:
+            self._query_params = dict()
+
+            query_string = self._scope["query_string"]
+
+            if query_string:
+                for name, value in _urllib.parse.parse_qsl(query_string.decode("utf-8")):
+                    self._query_params.setdefault(name, []).append(value)
+
+        return self._query_params
+
     def get_header(self, name):
-        name = name.encode("utf-8").lower()
+        value = self.get_header_bytes(name)
+
+        if value is not None:
+            return value.decode("utf-8")
+
+    # The name may be str or bytes.  The first value is returned.
+    def get_header_bytes(self, name):
+        values = self.get_header_values(name)
+
+        if values:
+            return values[0]
+
+    def get_header_values(self, name):
+        if isinstance(name, str):
+            name = name.encode("utf-8")
+
+        if self._headers is None:
+            self._headers = dict()
+
+            for header_name, header_value in self._scope["headers"]:
+                self._headers.setdefault(header_name.lower(), []).append(header_value)
+
+        return self._headers.get(name.lower(), ())
+
+    # Returns the offered content type the Accept header likes best, or
+    # None if it accepts none of them
+    def negotiate_content_type(self, offered):
+        return _negotiate_content_type(self._get_list_header(b"accept"), tuple(offered))
+
+    # Returns the offered coding the Accept-Encoding header likes best,
+    # or None if it accepts none of them.  Include "identity" in the
+    # offered codings to allow an unencoded response.
+    def negotiate_content_encoding(self, offered):
+        return _negotiate_content_encoding(self._get_list_header(b"accept-encoding"), tuple(offered))
+
+    # Joins repeated comma-separated list headers into one value
+    def _get_list_header(self, name):
+        values = self.get_header_values(name)
+
+        if len(values) == 1:
+            return values[0]
+
+        if values:
+            return b",".join(values)
+
+    @property
+    def cookies(self):
+        if self._cookies is None:
+            self._cookies = dict()
+
+            for header_value in self.get_header_values(b"cookie"):
+                # Cookie values come from the client, so bad bytes are replaced, not fatal
+                for item in header_value.decode("utf-8", errors="replace").split(";"):
+                    name, sep, value = item.partition("=")
+
+                    if not sep:
+                        continue
+
+                    value = value.strip()
+
+                    if len(value) > 1 and value[0] == value[-1] == '"':
+                        value = value[1:-1]
+
+                    self._cookies.setdefault(name.strip(), value)
 
-        for header_name, header_value in self._scope["headers"]:
-            if header_name.lower() == name:
-                return header_value.decode("utf-8")
+        return self._cookies
+
+    # Returns the value of a cookie signed by the server's
+    # cookie_signer, or None if it is missing or the signature is bad
+    def get_signed_cookie(self, name):
+        assert self._server.cookie_signer is not None
+
+        signed_value = self.cookies.get(name)
+
+        if signed_value is not None:
+            return self._server.cookie_signer.verify(signed_value)
+
+    # Runs the handler in the current task while a watcher task waits
+    # for the client to go away and then cancels it.  The watcher alone
+    # calls receive().  It hands body messages over one at a time, so
+    # the body still streams with backpressure.  Servers report a
+    # disconnect once the response is complete, so one after that is
+    # ignored.
+    async def _run_watched(self, coro):
+        task = _asyncio.current_task()
+        watcher = _asyncio.create_task(self._watch_for_disconnect(task))
+
+        self._watched = True
+
+        try:
+            await coro
+        except _asyncio.CancelledError:
+            if not self.disconnected:
+                raise
+
+            # The cancel came from the watcher, not the server
+            if hasattr(task, "uncancel"):
+                task.uncancel()
+
+            _log.debug("Client disconnected: %s", self)
+        finally:
+            watcher.cancel()
+
+    async def _watch_for_disconnect(self, task):
+        while True:
+            message = await self._receive()
+
+            if message["type"] == "http.disconnect":
+                if not self._response_complete:
+                    self.disconnected = True
+                    task.cancel()
+
+                return
+
+            waiter = self._message_waiter
+
+            # The handler is already waiting for it
+            if waiter is not None:
+                self._message_waiter = None
+                waiter.set_result(message)
+                continue
+
+            self._pending_message = message
+
+            # Wait for the handler to take it before reading more
+            if message.get("more_body", False):
+                self._message_waiter = _asyncio.get_running_loop().create_future()
+                await self._message_waiter
+
+    async def _take_message(self):
+        message = self._pending_message
+
+        if message is None:
+            self._message_waiter = _asyncio.get_running_loop().create_future()
+            return await self._message_waiter
+
+        self._pending_message = None
+        waiter = self._message_waiter
+
+        # Let the watcher read more
+        if waiter is not None:
+            self._message_waiter = None
+            waiter.set_result(None)
+
+        return message
+
+    # Yields the body in chunks as they arrive.  The body can be
+    # streamed only once, unless get_body() has already buffered it.
+    async def stream(self):
+        if self._body is not None:
+            if self._body:
+                yield self._body
+
+            return
+
+        assert not self._streamed, "The body has already been streamed"
+
+        self._streamed = True
+        max_size = self.max_body_size
+        size = 0
+
+        if max_size is not None:
+            length = self.get_header_bytes(b"content-length")
+
+            if length is not None and length.isdigit() and int(length) > max_size:
+                raise PayloadTooLargeError(f"Request body exceeds {max_size} bytes")
+
+        while True:
+            if self._watched:
+                message = await self._take_message()
+            else:
+                message = await self._receive()
+
+            type = message["type"]
+
+            if type == "http.request":
+                chunk = message.get("body", b"")
+                size += len(chunk)
+
+                if max_size is not None and size > max_size:
+                    raise PayloadTooLargeError(f"Request body exceeds {max_size} bytes")
+
+                if chunk:
+                    yield chunk
+
+                if not message.get("more_body", False):
+                    return
+            elif type == "http.disconnect":
+                self.disconnected = True
+                raise ClientDisconnected()
+            else:
+                assert False, type # pragma: nocover
 
     async def get_body(self):
-        message = await self._receive()
-        type = message["type"]
+        if self._body is None:
+            self._body = b"".join([x async for x in self.stream()])
 
-        if type == "http.request":
-            assert message.get("more_body") in (None, False) # XXX Need to handle streamed data
+        return self._body
 
-            return message.get("body", "")
-        elif type == "http.disconnect": # pragma: nocover
-            assert False, type # XXX Need a disconnect exception
-        else:
-            assert False, type # pragma: nocover
+    # Returns a file object positioned at the start of the body.  Bodies
+    # larger than the server's body_spool_size are kept on disk.
+    async def get_body_file(self):
+        file = _tempfile.SpooledTemporaryFile(max_size=self._server.body_spool_size)
+
+        async for chunk in self.stream():
+            file.write(chunk)
+
+        file.seek(0)
 
+        return file
+
+    # If the server has a json_executor, bodies larger than its
+    # json_offload_size are decoded there, off the event loop
     async def parse_json(self) -> object:
-        return _json.loads(await self.get_body())
+        body = await self.get_body()
+        loads = self._server.json_codec.loads
+
+        try:
+            if self._server.json_executor is not None and len(body) > self._server.json_offload_size:
+                return await self._server._run_json_task(loads, body)
+
+            return loads(body)
+        except ValueError as e:
+            raise BadRequestError(f"Failed parsing JSON: {e}")
+
+    # Yields a MultipartPart for each part of a multipart/form-data
+    # body as it streams in.  Read each part before moving to the next
+    # one.  Any part left unread is skipped.
+    async def parse_multipart(self):
+        content_type = self.get_header("content-type") or ""
+        match = _re.search(r';\s*boundary=(?:"([^"]+)"|([^;\s]+))', content_type, _re.IGNORECASE)
+
+        if not content_type.lstrip().lower().startswith("multipart/") or match is None:
+            raise BadRequestError("Request body is not multipart")
+
+        boundary = (match.group(1) or match.group(2)).encode("utf-8")
+        reader = _MultipartReader(self.stream(), boundary)
+
+        async for part in reader.read_parts():
+            yield part
+
+    # If the server has a json_executor, data holding more items than
+    # its json_offload_items is by default encoded there.  Items are
+    # counted two levels down, so {"items": [...]} counts its rows.
+    # Without an executor, nothing is offloaded: a thread would hold
+    # the GIL for the whole encode and stall the event loop anyway.
+    async def respond_json(self, code, data, content_type=None, etag=None, offload=None):
+        dumps = self._server.json_codec.dumps
+
+        if self._server.json_executor is None:
+            offload = False
+        elif offload is None:
+            limit = self._server.json_offload_items
+            offload = _count_json_items(data, limit) > limit
+
+        if offload:
+            content = await self._server._run_json_task(dumps, data)
+        else:
+            content = dumps(data)
 
-    async def respond(self, code, content=b"", content_type=None, etag=None):
+        await self.respond(code, content, content_type=content_type or "application/json", etag=etag)
+
+    # The content can be bytes, str, None, a path-like object naming a
+    # file to send, or, to stream the response, an async iterable or
+    # generator of bytes or str chunks.  Pass content_encoding if the
+    # content is already encoded, or "identity" to send it as is.
+    async def respond(self, code, content=b"", content_type=None, etag=None, content_encoding=None):
         assert isinstance(code, int), type(code)
-        assert content is None or isinstance(content, (bytes, str)), type(content)
+        assert content is None or isinstance(content, (bytes, str, _os.PathLike)) or _is_stream(content), \
+            type(content)
         assert content_type is None or isinstance(content_type, str), type(content_type)
         assert etag is None or isinstance(etag, str), type(etag)
+        assert content_encoding is None or isinstance(content_encoding, str), type(content_encoding)
+
+        headers = self._server._get_default_headers() + self._extra_headers
+        coding = None
+        file_path = None
 
-        headers = [
-            (b"content-security-policy", self._server.csp.encode("utf-8")),
-            (b"referrer-policy", b"no-referrer"),
-            (b"x-content-type-options", b"nosniff"),
-        ]
+        if content is None:
+            content = b""
+        elif isinstance(content, str):
+            content = content.encode("utf-8")
+
+        if isinstance(content, _os.PathLike):
+            file_path = _os.path.abspath(content)
+            size = _os.path.getsize(file_path)
+        elif _is_stream(content):
+            size = None
+        else:
+            size = len(content)
 
         if content_type is not None:
             headers.append((b"content-type", content_type.encode("utf-8")))
 
+        if content_encoding is not None:
+            headers.append((b"vary", b"accept-encoding"))
+
+            if content_encoding != "identity":
+                headers.append((b"content-encoding", content_encoding.encode("ascii")))
+        elif content_type is not None:
+            if self._is_compressible(code, size, content_type):
+                headers.append((b"vary", b"accept-encoding"))
+                coding = _content_codings.get(self.negotiate_content_encoding(_offered_content_codings))
+
+        if coding is not None:
+            headers.append((b"content-encoding", coding.name.encode("ascii")))
+
+            # The encoded bytes differ, so the tag can only be weak
+            if etag is not None and not etag.startswith("W/"):
+                etag = f"W/{etag}"
+
+            if isinstance(content, bytes):
+                content = coding.compress(content)
+
         if etag is not None:
             headers.append((b"etag", etag.encode("utf-8")))
 
-        if isinstance(content, str):
-            content = content.encode("utf-8")
+        if file_path is not None:
+            if coding is None:
+                headers.append((b"content-length", str(size).encode("ascii")))
+
+                # The server reads the file itself, so it never passes through Python
+                if "http.response.pathsend" in self._scope.get("extensions", _no_params):
+                    self._response_started = True
+                    await self._send({"type": "http.response.start", "status": code, "headers": headers})
+                    await self._send({"type": "http.response.pathsend", "path": file_path})
+                    self._response_complete = True
+                    return
+
+            content = _read_file_ranges(open(file_path, "rb"), ((0, size - 1),))
 
         start_message = {
             "type": "http.response.start",
@@ -322,18 +1394,516 @@ class Request:
             "headers": headers,
         }
 
+        self._response_started = True
+        await self._send(start_message)
+
+        if _is_stream(content):
+            await self._send_stream(content, None if coding is None else coding.start())
+            return
+
         body_message = {
             "type": "http.response.body",
             "body": content,
             "more_body": False,
         }
 
-        await self._send(start_message)
         await self._send(body_message)
+        self._response_complete = True
+
+    # Once the response has started, an error can only cut it short.
+    # The body is left unfinished, so the server drops the connection
+    # and the client can tell the response is incomplete.
+    async def _respond_error(self, code, message):
+        if self._response_started:
+            _log.error("Abandoning a response already started: %s", self)
+            return
+
+        await self.respond(code, message)
+
+    async def _send_stream(self, chunks, compressor=None):
+        if not hasattr(chunks, "__aiter__"):
+            chunks = _iterate_async(chunks)
+
+        async for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+
+            # Each compressed chunk is flushed, so it goes out right away
+            if chunk and compressor is not None:
+                chunk = compressor.compress(chunk)
+
+            if chunk:
+                await self._send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+        final_chunk = b"" if compressor is None else compressor.finish()
+
+        await self._send({"type": "http.response.body", "body": final_chunk, "more_body": False})
+        self._response_complete = True
+
+    # A size of None means a stream of unknown length
+    def _is_compressible(self, code, size, content_type):
+        server = self._server
+
+        if not server.compress_responses or code < 200 or code in (204, 206, 304):
+            return False
+
+        if content_type.partition(";")[0].strip().lower() in _incompressible_content_types:
+            return False
+
+        return size is None or size >= server.compression_min_size
+
+# Stops counting once past the limit, so the cost stays bounded
+def _count_json_items(data, limit, depth=2):
+    if isinstance(data, dict):
+        values = data.values()
+    elif isinstance(data, (list, tuple)):
+        values = data
+    else:
+        return 0
+
+    count = len(data)
+
+    if depth == 1 or count > limit:
+        return count
+
+    for value in values:
+        count += _count_json_items(value, limit - count, depth - 1)
+
+        if count > limit:
+            break
+
+    return count
+
+def _is_stream(content):
+    return hasattr(content, "__aiter__") or isinstance(content, _types.GeneratorType)
+
+async def _iterate_async(iterator):
+    for item in iterator:
+        yield item
+
+_missing = object()
+_no_params = _types.MappingProxyType(dict())
+_no_headers = list() # Never modified
+
+class MultipartPart:
+    def __init__(self, reader, headers):
+        self.headers = headers
+        self.content_type = headers.get("content-type", "text/plain")
+
+        disposition = headers.get("content-disposition", "")
+        params = dict()
+
+        for name, quoted, unquoted in _re.findall(r';\s*([\w*]+)=(?:"((?:[^"\\]|\\.)*)"|([^;]*))', disposition):
+            params[name.lower()] = quoted.replace('\\"', '"') if quoted else unquoted.strip()
+
+        self.name = params.get("name")
+        self.filename = params.get("filename")
+
+        self._reader = reader
+
+    def __repr__(self):
+        return _format_repr(self, self.name, self.filename)
+
+    async def stream(self):
+        async for chunk in self._reader.read_part_body(self):
+            yield chunk
+
+    async def read(self):
+        return b"".join([x async for x in self.stream()])
+
+    # Each sink is a file-like object with write() or a hash object
+    # with update().  Returns the number of bytes written.
+    async def write_to(self, *sinks):
+        writes = [getattr(x, "write", None) or x.update for x in sinks]
+        size = 0
+
+        async for chunk in self.stream():
+            size += len(chunk)
+
+            for write in writes:
+                write(chunk)
+
+        return size
+
+# Holds at most one chunk plus a delimiter's worth of bytes, however
+# large the parts are
+class _MultipartReader:
+    max_header_size = 16 * 1024
+
+    def __init__(self, chunks, boundary):
+        self._chunks = chunks
+        self._delimiter = b"\r\n--" + boundary
+        self._buffer = bytearray(b"\r\n") # Lets a delimiter at the very start match
+        self._current_part = None
+
+    async def _fill(self):
+        chunk = await anext(self._chunks, None)
+
+        if chunk is None:
+            raise BadRequestError("Unexpected end of multipart body")
+
+        self._buffer += chunk
+
+    async def read_parts(self):
+        # Skip the preamble
+        async for _ in self._read_until_delimiter():
+            pass
+
+        while True:
+            while (end := self._buffer.find(b"\r\n")) == -1:
+                # The close delimiter needs no CRLF after it
+                if self._buffer.startswith(b"--"):
+                    return
+
+                await self._fill()
+
+            line = self._buffer[:end].strip()
+            del self._buffer[:end + 2]
+
+            if line == b"--":
+                return
+
+            if line:
+                raise BadRequestError("Malformed multipart boundary")
+
+            part = MultipartPart(self, await self._read_headers())
+            self._current_part = part
+
+            yield part
+
+            # Skip whatever the caller left unread
+            async for _ in self.read_part_body(part):
+                pass
+
+    async def _read_headers(self):
+        headers = dict()
+
+        while True:
+            if self._buffer.startswith(b"\r\n"):
+                del self._buffer[:2]
+                return headers
+
+            end = self._buffer.find(b"\r\n\r\n")
+
+            if end != -1:
+                break
+
+            if len(self._buffer) > self.max_header_size:
+                raise BadRequestError("Multipart headers are too large")
+
+            await self._fill()
+
+        try:
+            text = self._buffer[:end].decode("utf-8")
+        except UnicodeDecodeError:
+            raise BadRequestError("Malformed multipart headers")
+
+        for line in text.split("\r\n"):
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        del self._buffer[:end + 4]
+
+        return headers
+
+    async def read_part_body(self, part):
+        if part is not self._current_part:
+            return
+
+        async for chunk in self._read_until_delimiter():
+            yield chunk
+
+        self._current_part = None
+
+    async def _read_until_delimiter(self):
+        delimiter = self._delimiter
+        keep = len(delimiter) - 1
+
+        while True:
+            index = self._buffer.find(delimiter)
+
+            if index != -1:
+                if index:
+                    yield bytes(self._buffer[:index])
+
+                del self._buffer[:index + len(delimiter)]
+
+                return
+
+            # Hold back enough to catch a delimiter split across chunks
+            if len(self._buffer) > keep:
+                yield bytes(self._buffer[:-keep])
+                del self._buffer[:-keep]
+
+            await self._fill()
 
 class BadRequestError(Exception):
     pass
 
+class PayloadTooLargeError(BadRequestError):
+    pass
+
+class ClientDisconnected(Exception):
+    pass
+
+class RouteError(Exception):
+    pass
+
+# Signs cookie values with HMAC-SHA256 as "value.signature".  Recent
+# verification results are cached by signed value, so repeat requests
+# from the same session skip the HMAC.
+class CookieSigner:
+    def __init__(self, secret, cache_size=1024):
+        if isinstance(secret, str):
+            secret = secret.encode("utf-8")
+
+        self._secret = secret
+        self.verify = _functools.lru_cache(maxsize=cache_size)(self._verify)
+
+    def __repr__(self):
+        return _format_repr(self)
+
+    def sign(self, value):
+        return f"{value}.{self._get_signature(value)}"
+
+    # A signed value that cannot even be encoded fails verification
+    def _verify(self, signed_value):
+        value, _, signature = signed_value.rpartition(".")
+
+        try:
+            signature = signature.encode("ascii")
+            expected = self._get_signature(value).encode("ascii")
+        except UnicodeEncodeError:
+            return None
+
+        if _hmac.compare_digest(signature, expected):
+            return value
+
+    def _get_signature(self, value):
+        digest = _hmac.digest(self._secret, value.encode("utf-8"), "sha256")
+        return _base64.urlsafe_b64encode(digest).rstrip(b"=").decode("ascii")
+
+# Negotiation results are cached by raw header value and offer.
+# Browsers send a few header values over and over, so most requests
+# cost one lookup.
+
+@_functools.lru_cache(maxsize=256)
+def _negotiate_content_type(accept, offered):
+    if accept is None:
+        return offered[0] if offered else None
+
+    ranges = _parse_quality_list(accept)
+    best, best_quality = None, 0
+
+    for content_type in offered:
+        base_type = content_type.partition(";")[0].strip().lower()
+        quality, specificity = None, -1
+
+        # The most specific matching range sets the quality
+        for media_range, range_quality in ranges:
+            if media_range == base_type:
+                range_specificity = 2
+            elif media_range == base_type.partition("/")[0] + "/*":
+                range_specificity = 1
+            elif media_range == "*/*":
+                range_specificity = 0
+            else:
+                continue
+
+            if range_specificity > specificity:
+                quality, specificity = range_quality, range_specificity
+
+        if quality is not None and quality > best_quality:
+            best, best_quality = content_type, quality
+
+    return best
+
+@_functools.lru_cache(maxsize=256)
+def _negotiate_content_encoding(accept_encoding, offered):
+    if accept_encoding is None:
+        return "identity" if "identity" in offered else None
+
+    qualities = dict()
+
+    for coding, quality in _parse_quality_list(accept_encoding):
+        qualities.setdefault(coding, quality)
+
+    # Unless ruled out, identity is acceptable but least preferred
+    default_quality = qualities.get("*")
+    best, best_quality = None, 0
+
+    for coding in offered:
+        quality = qualities.get(coding, default_quality)
+
+        if quality is None:
+            quality = 0.001 if coding == "identity" else 0
+
+        if quality > best_quality:
+            best, best_quality = coding, quality
+
+    return best
+
+def _parse_quality_list(value):
+    items = list()
+
+    for item in value.decode("latin-1").split(","):
+        token, *params = item.split(";")
+        token = token.strip().lower()
+        quality = 1
+
+        if not token:
+            continue
+
+        for param in params:
+            name, _, param_value = param.partition("=")
+
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(param_value)
+                except ValueError:
+                    quality = 0
+
+        items.append((token, quality))
+
+    return items
+
+# A content coding for response compression.  compress() encodes a
+# whole body.  start() returns an object whose compress() encodes and
+# flushes one chunk and whose finish() ends the stream.
+class _ContentCoding:
+    def __init__(self, name, compress, start):
+        self.name = name
+        self.compress = compress
+        self.start = start
+
+class _ZlibCompressor:
+    def __init__(self, wbits):
+        self._compressor = _zlib.compressobj(6, _zlib.DEFLATED, wbits)
+
+    def compress(self, chunk):
+        return self._compressor.compress(chunk) + self._compressor.flush(_zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+class _BrotliCompressor:
+    def __init__(self):
+        import brotli
+        self._compressor = brotli.Compressor(quality=4)
+
+    def compress(self, chunk):
+        return self._compressor.process(chunk) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+class _ZstdCompressor:
+    def __init__(self):
+        import zstandard
+        self._flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        self._compressor = zstandard.ZstdCompressor(level=3).compressobj()
+
+    def compress(self, chunk):
+        return self._compressor.compress(chunk) + self._compressor.flush(self._flush_mode)
+
+    def finish(self):
+        return self._compressor.flush()
+
+def _find_content_codings():
+    codings = list()
+
+    try:
+        import brotli
+    except ImportError:
+        pass
+    else:
+        codings.append(_ContentCoding("br", lambda x: brotli.compress(x, quality=4), _BrotliCompressor))
+
+    try:
+        import zstandard
+    except ImportError:
+        pass
+    else:
+        compressor = zstandard.ZstdCompressor(level=3)
+        codings.append(_ContentCoding("zstd", compressor.compress, _ZstdCompressor))
+
+    codings.append(_ContentCoding("gzip", lambda x: _gzip.compress(x, compresslevel=6, mtime=0),
+                                  lambda: _ZlibCompressor(31)))
+    codings.append(_ContentCoding("deflate", lambda x: _zlib.compress(x, 6), lambda: _ZlibCompressor(15)))
+
+    return {x.name: x for x in codings}
+
+# In order of preference
+_content_codings = _find_content_codings()
+_offered_content_codings = tuple(_content_codings) + ("identity",)
+
+# Encodes to and decodes from UTF-8 JSON bytes
+class JsonCodec:
+    def __init__(self, name, loads, dumps):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+    def __repr__(self):
+        return _format_repr(self, self.name)
+
+def _find_json_codecs():
+    codecs = list()
+
+    try:
+        import orjson
+    except ImportError:
+        pass
+    else:
+        codecs.append(JsonCodec("orjson", orjson.loads, _orjson_dumps))
+
+    try:
+        import ujson
+    except ImportError:
+        pass
+    else:
+        codecs.append(JsonCodec("ujson", ujson.loads, _ujson_dumps))
+
+    codecs.append(JsonCodec("json", _json.loads, _stdlib_json_dumps))
+
+    return codecs
+
+# Module-level functions, not lambdas, so a process pool can pickle
+# them.  The faster codecs reject some data the stdlib accepts, such
+# as integers over 64 bits.  They fall back to the stdlib for that, so
+# every codec encodes the same data.
+
+def _orjson_dumps(data):
+    import orjson
+
+    try:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+        return _stdlib_json_dumps(data)
+
+def _ujson_dumps(data):
+    import ujson
+
+    try:
+        return ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False).encode("utf-8")
+    except (TypeError, OverflowError):
+        return _stdlib_json_dumps(data)
+
+def _stdlib_json_dumps(data):
+    return _json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+# In order of preference
+_json_codecs = _find_json_codecs()
+_default_json_codec = _json_codecs[0]
+
+# Already compressed, so not worth compressing again
+_incompressible_content_types = {
+    "application/font-woff",
+    "application/pdf",
+    "image/jpeg",
+    "image/png",
+}
+
 _content_types_by_extension = {
     ".css": "text/css;charset=UTF-8",
     ".html": "text/html;charset=UTF-8",
@@ -348,9 +1918,91 @@ _content_types_by_extension = {
     ".woff": "application/font-woff",
 }
 
+# Precompressed files sit next to the original, as in app.js.br.  In
+# order of preference.
+_sidecar_extensions_by_coding = {
+    "br": ".br",
+    "zstd": ".zst",
+    "gzip": ".gz",
+}
+
+# A file to serve.  If a precompressed variant was chosen, coding is
+# its content coding and sidecar_path is where it lives.
+class _StaticFile:
+    __slots__ = ("fs_path", "sidecar_path", "coding")
+
+    def __init__(self, fs_path, sidecar_path=None, coding=None):
+        self.fs_path = fs_path
+        self.sidecar_path = sidecar_path
+        self.coding = coding
+
+# More ranges than this and the whole file is sent instead
+_max_byte_ranges = 16
+_byte_range_spec_regex = _re.compile(r"(\d*)-(\d*)")
+_file_chunk_size = 64 * 1024
+
+# Returns a list of inclusive (start, end) offsets, an empty list if
+# no range is satisfiable, or None if the header should be ignored
+def _parse_byte_ranges(value, size):
+    unit, _, specs = value.decode("latin-1").partition("=")
+
+    if unit.strip().lower() != "bytes":
+        return None
+
+    ranges = list()
+
+    for spec in specs.split(","):
+        match = _byte_range_spec_regex.fullmatch(spec.strip())
+
+        if match is None or match.group(1) == match.group(2) == "":
+            return None
+
+        first, last = match.groups()
+
+        if first == "":
+            start, end = size - int(last), size - 1
+
+            if start < 0:
+                start = 0
+        else:
+            start = int(first)
+            end = size - 1 if last == "" else min(int(last), size - 1)
+
+            if last != "" and int(last) < start:
+                return None
+
+        if start <= end:
+            ranges.append((start, end))
+
+    return ranges
+
+# Yields the given spans of an open file, each preceded by its entry in
+# separators, if any.  The last separator comes after the last span.
+def _read_file_ranges(file, ranges, separators=None):
+    with file:
+        for i, (start, end) in enumerate(ranges):
+            if separators is not None:
+                yield separators[i]
+
+            file.seek(start)
+            remaining = end + 1 - start
+
+            while remaining > 0:
+                chunk = file.read(min(remaining, _file_chunk_size))
+
+                if not chunk:
+                    break
+
+                remaining -= len(chunk)
+
+                yield chunk
+
+        if separators is not None:
+            yield separators[-1]
+
 class StaticDirectoryResource(Resource):
-    def __init__(self, dir, app=None):
-        super().__init__(app=app, methods=("GET", "HEAD"))
+    def __init__(self, dir, app=None, headers=None):
+        super().__init__(app=app, methods=("GET", "HEAD"), headers={"Accept-Ranges": "bytes", **(headers or dict())})
 
         assert _os.path.isdir(dir), dir
 
@@ -358,33 +2010,124 @@ class StaticDirectoryResource(Resource):
 
     async def handle(self, request):
         try:
+            if request.method == "GET" and request.get_header_bytes(b"range") is not None:
+                if await self._handle_range(request):
+                    return
+
             await super().handle(request)
         except FileNotFoundError:
             await request.respond(404, "Not found")
 
+    # Returns False if the whole file should be sent instead
+    async def _handle_range(self, request):
+        file = await self.process(request)
+        etag = f'"{await self.get_etag(request, file)}"'
+        encoded_etag = etag.encode("utf-8")
+
+        client_etag = request.get_header_bytes(b"if-none-match")
+
+        if client_etag is not None and client_etag.removeprefix(b"W/") == encoded_etag:
+            return False
+
+        # We send no Last-Modified, so only an exact ETag can match
+        if_range = request.get_header_bytes(b"if-range")
+
+        if if_range is not None and if_range != encoded_etag:
+            return False
+
+        fs_path = file.sidecar_path or file.fs_path
+        size = _os.path.getsize(fs_path)
+        ranges = _parse_byte_ranges(request.get_header_bytes(b"range"), size)
+
+        if ranges is None or len(ranges) > _max_byte_ranges:
+            return False
+
+        if not ranges:
+            request._extra_headers = request._extra_headers + [(b"content-range", f"bytes */{size}".encode("ascii"))]
+            await request.respond(416, "Range not satisfiable")
+            return True
+
+        content_type = await self.get_content_type(request, file)
+        content_length = sum(end + 1 - start for start, end in ranges)
+        separators = None
+
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            headers = [(b"content-range", f"bytes {start}-{end}/{size}".encode("ascii"))]
+        else:
+            boundary = _uuid.uuid4().hex
+            separators = list()
+
+            for start, end in ranges:
+                separators.append((f"\r\n--{boundary}\r\n"
+                                   f"Content-Type: {content_type}\r\n"
+                                   f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode("utf-8"))
+
+            separators.append(f"\r\n--{boundary}--\r\n".encode("ascii"))
+
+            content_type = f"multipart/byteranges; boundary={boundary}"
+            content_length += sum(len(x) for x in separators)
+            headers = list()
+
+        headers.append((b"content-length", str(content_length).encode("ascii")))
+        request._extra_headers = request._extra_headers + headers
+
+        content = _read_file_ranges(open(fs_path, "rb"), ranges, separators)
+
+        await request.respond(206, content, content_type=content_type, etag=etag, content_encoding=file.coding)
+
+        return True
+
     async def process(self, request):
         subpath = request.require("subpath")
 
         assert subpath is not None
         assert subpath.startswith("/"), subpath
 
-        return _os.path.join(self.dir, subpath[1:])
+        fs_path = _os.path.join(self.dir, subpath[1:])
+
+        if request.get_header_bytes(b"accept-encoding") is None:
+            return _StaticFile(fs_path)
+
+        # Only the sidecars present are offered
+        sidecar_paths = {coding: fs_path + ext for coding, ext in _sidecar_extensions_by_coding.items()
+                         if _os.path.isfile(fs_path + ext)}
 
-    async def get_etag(self, request, fs_path):
-        mtime = _os.path.getmtime(fs_path)
-        return _struct.pack("f", mtime).hex()
+        if not sidecar_paths:
+            return _StaticFile(fs_path)
 
-    async def get_content_type(self, request, fs_path):
-        _, ext = _os.path.splitext(fs_path)
+        coding = request.negotiate_content_encoding(tuple(sidecar_paths) + ("identity",))
+
+        if coding not in sidecar_paths:
+            return _StaticFile(fs_path, coding="identity")
+
+        return _StaticFile(fs_path, sidecar_paths[coding], coding)
+
+    async def get_etag(self, request, file):
+        mtime = _os.path.getmtime(file.fs_path)
+        etag = _struct.pack("f", mtime).hex()
+
+        if file.sidecar_path is not None:
+            mtime = _os.path.getmtime(file.sidecar_path)
+            etag = f"{etag}-{_struct.pack('f', mtime).hex()}-{file.coding}"
+
+        return etag
+
+    async def get_content_type(self, request, file):
+        _, ext = _os.path.splitext(file.fs_path)
         return _content_types_by_extension.get(ext, "text/plain;charset=UTF-8")
 
-    async def render(self, request, fs_path):
-        with open(fs_path, "r") as file:
-            return file.read()
+    async def get_content_encoding(self, request, file):
+        return file.coding
+
+    # Returns the path, so the file is streamed or handed to the server
+    # rather than read here
+    async def render(self, request, file):
+        return _pathlib.Path(file.sidecar_path or file.fs_path)
 
 class PinnedFileResource(Resource):
-    def __init__(self, file, app=None):
-        super().__init__(app=app, methods=("GET", "HEAD"))
+    def __init__(self, file, app=None, headers=None):
+        super().__init__(app=app, methods=("GET", "HEAD"), headers=headers)
 
         assert _os.path.isfile(file), file
 
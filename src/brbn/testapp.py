@@ -20,12 +20,21 @@
 from brbn import *
 from brbn.plano import *
 
+import gzip
+import hashlib
+
 static_dir = make_temp_dir()
 
 write(join(static_dir, "alpha.txt"), "alpha")
 write(join(static_dir, "beta.html"), "beta")
+write(join(static_dir, "gamma.js"), "gamma")
+write(join(static_dir, "digits.txt"), "0123456789")
+
+with open(join(static_dir, "gamma.js.gz"), "wb") as file:
+    file.write(gzip.compress(b"gamma"))
 
 server = Server()
+api_server = Server()
 
 class Main(Resource):
     async def render(self, request, entity):
@@ -35,18 +44,81 @@ class Explode(Resource):
     async def process(self, request):
         raise Exception()
 
+class Hello(Resource):
+    async def render(self, request, entity):
+        return f"hello {request.path}"
+
+class Upload(Resource):
+    async def process(self, request):
+        size = 0
+
+        async for chunk in request.stream():
+            size += len(chunk)
+
+        return size
+
+    async def render(self, request, size):
+        return str(size)
+
+class Form(Resource):
+    async def process(self, request):
+        fields = list()
+
+        async for part in request.parse_multipart():
+            if part.filename is None:
+                fields.append(f"{part.name}={(await part.read()).decode()}")
+            else:
+                digest = hashlib.sha256()
+                size = await part.write_to(digest)
+                fields.append(f"{part.name}:{part.filename}:{size}:{digest.hexdigest()[:8]}")
+
+        return fields
+
+    async def render(self, request, fields):
+        return ",".join(fields)
+
+class Stream(Resource):
+    async def render(self, request, entity):
+        async def chunks():
+            for i in range(3):
+                yield f"chunk {i}\n"
+
+            yield b"done"
+
+        return chunks()
+
+class Large(Resource):
+    async def get_content_type(self, request, entity):
+        return "text/plain;charset=UTF-8"
+
+    async def render(self, request, entity):
+        return "large " * 1000
+
 class Json(Resource):
     async def process(self, request):
-        data = await request.parse_json()
+        return await request.parse_json()
+
+    async def render(self, request, data):
+        return data
 
 class RequiredParam(Resource):
     async def process(self, request):
         not_there = request.require("not-there")
 
-server.add_route("/", Main())
+server.add_route("/", Main(headers={"Cache-Control": "no-store"}))
 server.add_route("/explode", Explode())
-server.add_route("/files/alpha.txt", PinnedFileResource(join(static_dir, "alpha.txt")))
-server.add_route("/files/*", StaticDirectoryResource(static_dir))
+server.add_route("/files/alpha.txt", PinnedFileResource(join(static_dir, "alpha.txt"),
+                                                       headers={"Cache-Control": "no-cache"}))
+server.add_route("/files/*", StaticDirectoryResource(static_dir, headers={"Cache-Control": "max-age=60"}))
 server.add_route("/json", Json())
+server.add_route("/large", Large())
 server.add_route("/post-only", Resource(method="POST"))
 server.add_route("/required-param", RequiredParam())
+server.add_route("/upload", Upload(method="POST"))
+server.add_route("/small-upload", Upload(method="POST", max_body_size=10))
+server.add_route("/form", Form(method="POST"))
+server.add_route("/stream", Stream())
+
+api_server.add_route("/hello", Hello())
+
+server.mount("/api", api_server)
@@ -18,11 +18,20 @@
 #
 
 from .main import *
+from .main import _json_codecs
 from .plano import *
 from . import testapp
 
 import asyncio
+import concurrent.futures
+import gzip
+import hashlib
 import httpx
+import io
+import os
+import pathlib
+import uuid
+import zlib
 
 class TestServer:
     def __init__(self, server=testapp.server):
@@ -73,7 +82,9 @@ def request():
     scope = {
         "method": "GET",
         "path": "/",
-        "query_string": "bob=1&alice=2".encode("utf-8"),
+        "query_string": "bob=1&alice=2&tag=a&tag=b&id=3".encode("utf-8"),
+        "brbn.path_params": {"id": 7},
+        "headers": [(b"accept", b"text/html"), (b"X-Tag", b"a"), (b"x-tag", b"b")],
     }
 
     request = Request(server, scope, None, None)
@@ -93,6 +104,1015 @@ def request():
     with expect_exception(BadRequestError):
         request.require("not-there")
 
+    result = request.get("tag")
+    assert result == "b", result
+
+    result = request.getall("tag")
+    assert result == ["a", "b"], result
+
+    result = request.getall("not-there")
+    assert result == [], result
+
+    result = request.get("id")
+    assert result == 7, result
+
+    result = request.path_params
+    assert result == {"id": 7}, result
+
+    result = request.get_header("Accept")
+    assert result == "text/html", result
+
+    result = request.get_header_bytes(b"x-tag")
+    assert result == b"a", result
+
+    result = request.get_header_values("X-TAG")
+    assert result == [b"a", b"b"], result
+
+    result = request.get_header("not-there")
+    assert result is None, result
+
+    result = request.get_header_values("not-there")
+    assert list(result) == [], result
+
+@test
+async def request_body():
+    def make_request(chunks, headers=[]):
+        messages = [{"type": "http.request", "body": x, "more_body": True} for x in chunks]
+        messages.append({"type": "http.request", "body": b"", "more_body": False})
+
+        async def receive():
+            return messages.pop(0)
+
+        scope = {"method": "POST", "path": "/", "query_string": b"", "headers": headers}
+
+        return Request(Server(), scope, receive, None)
+
+    request = make_request([b"a", b"bc", b"", b"def"])
+
+    result = [x async for x in request.stream()]
+    assert result == [b"a", b"bc", b"def"], result
+
+    with expect_exception(AssertionError):
+        [x async for x in request.stream()]
+
+    request = make_request([b"{\"a\": ", b"[1, 2]}"])
+
+    result = await request.get_body()
+    assert result == b'{"a": [1, 2]}', result
+
+    result = await request.parse_json()
+    assert result == {"a": [1, 2]}, result
+
+    result = [x async for x in request.stream()]
+    assert result == [b'{"a": [1, 2]}'], result
+
+    request = make_request([b'{"a": "\xc3\xa9"}'])
+    request._server.json_codec = JsonCodec("test", lambda x: ("decoded", x), lambda x: b"encoded")
+
+    result = await request.parse_json()
+    assert result == ("decoded", b'{"a": "\xc3\xa9"}'), result
+
+    request = make_request([b'{"a": "\xc3\xa9"}'])
+
+    result = await request.parse_json()
+    assert result == {"a": "\u00e9"}, result
+
+    result = request._server.json_codec.dumps(result)
+    assert result == b'{"a":"\xc3\xa9"}', result
+
+    # Every available codec accepts the same data
+    for codec in _json_codecs:
+        result = codec.loads(codec.dumps({1: "a", "big": 2 ** 70, "b": [True, None, 1.5]}))
+        assert result == {"1": "a", "big": 2 ** 70, "b": [True, None, 1.5]}, (codec, result)
+
+        with expect_exception(TypeError):
+            codec.dumps({"a": object()})
+
+    class CountingExecutor(concurrent.futures.ThreadPoolExecutor):
+        submitted = 0
+
+        def submit(self, *args, **kwargs):
+            CountingExecutor.submitted += 1
+            return super().submit(*args, **kwargs)
+
+    with CountingExecutor() as executor:
+        request = make_request([b'[1, 2, ', b'3]'])
+        request._server.json_executor = executor
+        request._server.json_offload_size = 4
+        request._server.json_offload_items = 2
+
+        result = await request.parse_json()
+        assert result == [1, 2, 3], result
+        assert CountingExecutor.submitted == 1, CountingExecutor.submitted
+
+        sent = list()
+
+        async def send(message):
+            sent.append(message)
+
+        request._send = send
+
+        await request.respond_json(200, [1, 2])
+        assert CountingExecutor.submitted == 1, CountingExecutor.submitted
+
+        await request.respond_json(200, result)
+        assert CountingExecutor.submitted == 2, CountingExecutor.submitted
+
+        result = sent[-1]["body"]
+        assert result == b"[1,2,3]", result
+
+        # One top-level item holding many
+        await request.respond_json(200, {"items": [1, 2]})
+        assert CountingExecutor.submitted == 3, CountingExecutor.submitted
+
+        await request.respond_json(200, {"items": [1]})
+        assert CountingExecutor.submitted == 3, CountingExecutor.submitted
+
+        await request.respond_json(200, {"items": [1]}, offload=True)
+        assert CountingExecutor.submitted == 4, CountingExecutor.submitted
+
+        request = make_request([b'[1, 2, '])
+        request._server.json_executor = executor
+        request._server.json_offload_size = 4
+
+        with expect_exception(BadRequestError):
+            await request.parse_json()
+
+    # No executor, no offloading
+    request = make_request([b'[1, 2, 3]'])
+    request._server.json_offload_size = 4
+    request._server.json_offload_items = 2
+    request._send = send
+
+    async def run_json_task(function, arg):
+        assert False, "Offloaded"
+
+    request._server._run_json_task = run_json_task
+
+    result = await request.parse_json()
+    assert result == [1, 2, 3], result
+
+    await request.respond_json(200, result, offload=True)
+
+    result = sent[-1]["body"]
+    assert result == b"[1,2,3]", result
+
+    request = make_request([])
+
+    result = await request.get_body()
+    assert result == b"", result
+
+    request = make_request([b"abc", b"def"])
+    request.max_body_size = 5
+
+    with expect_exception(PayloadTooLargeError):
+        await request.get_body()
+
+    request = make_request([], headers=[(b"content-length", b"6")])
+    request.max_body_size = 5
+
+    with expect_exception(PayloadTooLargeError):
+        await request.get_body()
+
+    request = make_request([b"abc", b"def"])
+    request._server.body_spool_size = 4
+
+    with await request.get_body_file() as file:
+        result = file.read()
+        assert result == b"abcdef", result
+        assert file._rolled, file
+
+@test
+async def multipart():
+    body = (
+        b"preamble\r\n"
+        b"--xyz\r\n"
+        b'Content-Disposition: form-data; name="title"\r\n'
+        b"\r\n"
+        b"Hello\r\n"
+        b"--xyz\r\n"
+        b'Content-Disposition: form-data; name="file"; filename="a \\"b\\".txt"\r\n'
+        b"Content-Type: application/octet-stream\r\n"
+        b"\r\n"
+        b"line one\r\n--xy not a boundary\r\n"
+        b"--xyz\r\n"
+        b'Content-Disposition: form-data; name="skipped"\r\n'
+        b"\r\n"
+        b"unread\r\n"
+        b"--xyz--\r\n"
+        b"epilogue"
+    )
+
+    for chunk_size in (1, 7, len(body)):
+        chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+        messages = [{"type": "http.request", "body": x, "more_body": True} for x in chunks]
+        messages.append({"type": "http.request", "body": b"", "more_body": False})
+
+        async def receive():
+            return messages.pop(0)
+
+        headers = [(b"content-type", b"multipart/form-data; boundary=xyz")]
+        scope = {"method": "POST", "path": "/", "query_string": b"", "headers": headers}
+        request = Request(Server(), scope, receive, None)
+        parts = list()
+
+        async for part in request.parse_multipart():
+            if part.name == "title":
+                parts.append((part.name, part.filename, await part.read()))
+            elif part.name == "file":
+                file = io.BytesIO()
+                digest = hashlib.sha256()
+                size = await part.write_to(file, digest)
+
+                assert part.content_type == "application/octet-stream", part.content_type
+                assert size == len(file.getvalue()), size
+                assert digest.digest() == hashlib.sha256(file.getvalue()).digest()
+
+                parts.append((part.name, part.filename, file.getvalue()))
+            else:
+                parts.append((part.name, part.filename, None))
+
+        assert parts == [
+            ("title", None, b"Hello"),
+            ("file", 'a "b".txt', b"line one\r\n--xy not a boundary"),
+            ("skipped", None, None),
+        ], parts
+
+    async def parse(body, content_type=b"multipart/form-data; boundary=xyz"):
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+        async def receive():
+            return messages.pop(0)
+
+        headers = [(b"content-type", content_type)]
+        scope = {"method": "POST", "path": "/", "query_string": b"", "headers": headers}
+        request = Request(Server(), scope, receive, None)
+
+        return [(x.name, await x.read()) async for x in request.parse_multipart()]
+
+    # No CRLF after the close delimiter
+    result = await parse(b'--xyz\r\nContent-Disposition: form-data; name="a"\r\n\r\nA\r\n--xyz--')
+    assert result == [("a", b"A")], result
+
+    result = await parse(b'--xyz\r\nContent-Disposition: form-data; name="a"\r\n\r\nA\r\n--xyz--',
+                         b"Multipart/Form-Data; Boundary=xyz")
+    assert result == [("a", b"A")], result
+
+    with expect_exception(BadRequestError):
+        await parse(b'--xyz\r\nContent-Disposition: form-data; name="\xff"\r\n\r\nA\r\n--xyz--')
+
+    scope = {"method": "POST", "path": "/", "query_string": b"", "headers": [(b"content-type", b"text/plain")]}
+    request = Request(Server(), scope, None, None)
+
+    with expect_exception(BadRequestError):
+        [x async for x in request.parse_multipart()]
+
+@test
+async def disconnects():
+    messages = asyncio.Queue()
+
+    for message in [{"type": "http.request", "body": b"abc", "more_body": True},
+                    {"type": "http.request", "body": b"def", "more_body": False}]:
+        messages.put_nowait(message)
+
+    sent = list()
+    events = list()
+
+    async def send(message):
+        sent.append(message)
+
+    class Slow(Resource):
+        async def process(self, request):
+            events.append(await request.get_body())
+
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                events.append("cancelled")
+                raise
+
+    server = Server()
+    server.watch_disconnects = True
+    scope = {"type": "http", "method": "POST", "path": "/", "query_string": b"", "headers": []}
+    task = asyncio.create_task(Slow()(server, scope, messages.get, send))
+
+    await asyncio.sleep(0.1)
+    await messages.put({"type": "http.disconnect"})
+    await asyncio.wait_for(task, 1)
+
+    assert events == [b"abcdef", "cancelled"], events
+    assert sent == [], sent
+
+    messages = asyncio.Queue()
+    messages.put_nowait({"type": "http.disconnect"})
+
+    server.watch_disconnects = False
+    request = Request(server, scope, messages.get, send)
+
+    with expect_exception(ClientDisconnected):
+        await request.get_body()
+
+    assert request.disconnected
+
+    # Like uvicorn, report a disconnect once the response is complete
+    complete = asyncio.Event()
+    body_sent = False
+    requests = list()
+
+    async def receive():
+        nonlocal body_sent
+
+        if not body_sent:
+            body_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        await complete.wait()
+
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body" and not message.get("more_body", False):
+            complete.set()
+
+    class Lingering(Resource):
+        async def process(self, request):
+            requests.append(request)
+
+            await request.respond(200, "done")
+            await asyncio.sleep(0.05)
+
+            events.append("finished")
+
+    events.clear()
+    server.watch_disconnects = True
+
+    await Lingering()(server, scope, receive, send)
+
+    assert events == ["finished"], events
+    assert not requests[0].disconnected
+
+    # A request expecting 100 Continue isn't watched, so receive() isn't
+    # called before the handler reads the body
+    received = list()
+
+    async def receive():
+        received.append(True)
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    class Rejecting(Resource):
+        async def handle(self, request):
+            await asyncio.sleep(0.05)
+            events.append(len(received))
+            await request.respond(413)
+
+    events.clear()
+    scope = {**scope, "headers": [(b"expect", b"100-Continue")]}
+
+    await Rejecting()(server, scope, receive, send)
+
+    assert events == [0], events
+
+@test
+def negotiation():
+    def make_request(headers):
+        scope = {"method": "GET", "path": "/", "query_string": b"", "headers": headers}
+        return Request(Server(), scope, None, None)
+
+    html, json, text = "text/html;charset=UTF-8", "application/json", "text/plain"
+    offered = [html, json, text]
+
+    for accept, expected in [
+            (None, html),
+            (b"application/json", json),
+            (b"text/*;q=0.5, application/json;q=0.4", html),
+            (b"text/*;q=0.5, text/plain, */*;q=0.1", text),
+            (b"text/html;q=0, */*;q=0.2", json),
+            (b"text/html;level=1, image/png", html),
+            (b"image/png", None),
+            (b"text/html;q=bad, application/json;q=0.1", json),
+    ]:
+        request = make_request([] if accept is None else [(b"accept", accept)])
+        result = request.negotiate_content_type(offered)
+        assert result == expected, (accept, result)
+
+    request = make_request([(b"accept", b"image/png"), (b"accept", b"application/*")])
+    result = request.negotiate_content_type(offered)
+    assert result == json, result
+
+    offered = ["br", "gzip", "identity"]
+
+    for accept_encoding, expected in [
+            (None, "identity"),
+            (b"gzip, deflate, br", "br"),
+            (b"gzip;q=1.0, br;q=0.5", "gzip"),
+            (b"deflate", "identity"),
+            (b"deflate, identity;q=0", None),
+            (b"*;q=0", None),
+            (b"*", "br"),
+            (b"", "identity"),
+    ]:
+        request = make_request([] if accept_encoding is None else [(b"accept-encoding", accept_encoding)])
+        result = request.negotiate_content_encoding(offered)
+        assert result == expected, (accept_encoding, result)
+
+    result = make_request([]).negotiate_content_encoding(["gzip"])
+    assert result is None, result
+
+@test
+def cookies():
+    server = Server()
+    server.cookie_signer = CookieSigner("secret", cache_size=2)
+
+    signed = server.cookie_signer.sign("alice.1")
+    tampered = server.cookie_signer.sign("bob") + "x"
+
+    headers = [
+        (b"cookie", f'theme=dark; session={signed}; quoted="a b"; flag'.encode("utf-8")),
+        (b"cookie", f"bad={tampered}; theme=light".encode("utf-8")),
+    ]
+    scope = {"method": "GET", "path": "/", "query_string": b"", "headers": headers}
+    request = Request(server, scope, None, None)
+
+    result = request.cookies
+    assert result == {"theme": "dark", "session": signed, "quoted": "a b", "bad": tampered}, result
+
+    result = request.get_signed_cookie("session")
+    assert result == "alice.1", result
+
+    result = request.get_signed_cookie("bad")
+    assert result is None, result
+
+    result = request.get_signed_cookie("not-there")
+    assert result is None, result
+
+    request.get_signed_cookie("session")
+
+    result = server.cookie_signer.verify.cache_info()
+    assert (result.hits, result.misses) == (1, 2), result
+
+    result = CookieSigner("other").verify(signed)
+    assert result is None, result
+
+    headers = [(b"cookie", "session=abc.éé".encode("utf-8")), (b"cookie", b"other=\xff")]
+    scope = {"method": "GET", "path": "/", "query_string": b"", "headers": headers}
+    request = Request(server, scope, None, None)
+
+    result = request.get_signed_cookie("session")
+    assert result is None, result
+
+    result = request.cookies["other"]
+    assert result == "\ufffd", result
+
+    result = server.cookie_signer.verify("abc.\udcff")
+    assert result is None, result
+
+@test
+async def streaming_responses():
+    sent = list()
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"method": "GET", "path": "/", "query_string": b"", "headers": []}
+    request = Request(Server(), scope, None, send)
+
+    def chunks():
+        yield "a"
+        yield b""
+        yield b"b"
+
+    await request.respond(200, chunks(), content_type="text/plain")
+
+    result = [(x.get("body"), x.get("more_body")) for x in sent[1:]]
+    assert result == [(b"a", True), (b"b", True), (b"", False)], result
+
+    # Failing mid-stream leaves the body unfinished instead of starting
+    # a second response
+    class Failing(Resource):
+        async def render(self, request, entity):
+            def chunks():
+                yield "a"
+                raise Exception("Failed mid-stream")
+
+            return chunks()
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    sent.clear()
+
+    await Failing()(Server(), {**scope, "type": "http"}, receive, send)
+
+    result = [(x["type"], x.get("more_body")) for x in sent]
+    assert result == [("http.response.start", None), ("http.response.body", True)], result
+
+@test
+async def file_responses():
+    sent = list()
+
+    async def send(message):
+        sent.append(message)
+
+    with temp_file() as file:
+        write(file, "x" * 100)
+
+        scope = {"method": "GET", "path": "/", "query_string": b"", "headers": []}
+        request = Request(Server(), scope, None, send)
+
+        await request.respond(200, pathlib.Path(file), content_type="text/plain")
+
+        result = dict(sent[0]["headers"])[b"content-length"]
+        assert result == b"100", result
+
+        result = b"".join(x["body"] for x in sent[1:])
+        assert result == b"x" * 100, result
+
+        sent.clear()
+
+        scope["extensions"] = {"http.response.pathsend": {}}
+        request = Request(Server(), scope, None, send)
+
+        await request.respond(200, pathlib.Path(file), content_type="text/plain")
+
+        result = sent[1]
+        assert result == {"type": "http.response.pathsend", "path": os.path.abspath(file)}, result
+
+@test
+async def compression():
+    sent = list()
+
+    async def send(message):
+        sent.append(message)
+
+    server = Server()
+    content = "text " * 1000
+
+    scope = {"method": "GET", "path": "/", "query_string": b"", "headers": [(b"accept-encoding", b"deflate")]}
+    request = Request(server, scope, None, send)
+
+    await request.respond(200, content, content_type="text/plain", etag='"abc"')
+
+    headers = dict(sent[0]["headers"])
+    assert headers[b"content-encoding"] == b"deflate", headers
+    assert headers[b"vary"] == b"accept-encoding", headers
+    assert headers[b"etag"] == b'W/"abc"', headers
+
+    result = zlib.decompress(sent[1]["body"]).decode()
+    assert result == content, result
+
+    sent.clear()
+
+    scope = {"method": "GET", "path": "/", "query_string": b"", "headers": [(b"accept-encoding", b"gzip")]}
+    request = Request(server, scope, None, send)
+
+    def chunks():
+        yield "a" * 10
+        yield "b" * 10
+
+    await request.respond(200, chunks(), content_type="text/plain")
+
+    result = gzip.decompress(b"".join(x["body"] for x in sent[1:])).decode()
+    assert result == "a" * 10 + "b" * 10, result
+
+    sent.clear()
+
+    # Too small, already compressed, and switched off
+    await request.respond(200, "small", content_type="text/plain")
+    await request.respond(200, b"x" * 2000, content_type="image/png")
+
+    server.compress_responses = False
+    await request.respond(200, content, content_type="text/plain")
+
+    result = [b"content-encoding" in dict(x["headers"]) for x in sent[0::2]]
+    assert result == [False, False, False], result
+
+@test
+async def response_headers():
+    sent = list()
+
+    async def send(message):
+        sent.append(message)
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    server = Server()
+    resource = Resource(headers={"X-Frame-Options": "DENY"})
+    server.add_route("/", resource)
+
+    scope = {"type": "http", "method": "GET", "path": "/", "query_string": b"", "headers": []}
+
+    await server(scope, receive, send)
+
+    result = dict(sent[0]["headers"])
+    assert result[b"x-frame-options"] == b"DENY", result
+    assert result[b"content-security-policy"] == b"default-src 'self'", result
+
+    server.csp = "default-src 'none'"
+
+    await server(scope, receive, send)
+
+    result = dict(sent[2]["headers"])
+    assert result[b"content-security-policy"] == b"default-src 'none'", result
+
+    result = server._get_default_headers()
+    assert len(result) == 3, result
+
+    # Middleware may modify headers in place
+    async def send(message):
+        if message["type"] == "http.response.start":
+            message["headers"].append((b"x-added", b"1"))
+
+    for path in ("/not-there", "/", "/not-there"):
+        await server({**scope, "path": path}, receive, send)
+
+    result = server._get_default_headers()
+    assert len(result) == 3, result
+
+@test
+def routing():
+    server = Server()
+    main = Resource()
+    user = Resource()
+    user_new = Resource()
+    files = Resource()
+    report = Resource()
+
+    server.add_route("/", main)
+    server.add_route("/users/{id}", user)
+    server.add_route("/users/new", user_new)
+    server.add_route("/files/*", files)
+    server.add_route("/reports/q{quarter}-{year}", report)
+    server.add_route("/users/admin", user_new)
+    server.add_route("/files/index.html", main)
+    server.add_route("/about", main)
+    server.add_route("/about", user)
+
+    def find(path):
+        match = server._router.find_route(path, "GET")
+        return None if match is None else (match[0].resource, match[1])
+
+    result = find("/")
+    assert result == (main, {}), result
+
+    result = find("/users/alice")
+    assert result == (user, {"id": "alice"}), result
+
+    # The earlier route wins
+    result = find("/users/new")
+    assert result == (user, {"id": "new"}), result
+
+    result = find("/files")
+    assert result == (files, {"subpath": ""}), result
+
+    result = find("/files/a/b.txt")
+    assert result == (files, {"subpath": "/a/b.txt"}), result
+
+    result = find("/reports/q3-2024")
+    assert result == (report, {"quarter": "3", "year": "2024"}), result
+
+    result = find("/about")
+    assert result == (main, {}), result
+
+    result = server._router._static_endpoints
+    assert list(result) == ["/", "/about"], result
+
+    result = find("/users/admin")
+    assert result == (user, {"id": "admin"}), result
+
+    result = find("/files/index.html")
+    assert result == (files, {"subpath": "/index.html"}), result
+
+    for path in ("/users", "/users/", "/users/alice/x", "/reports/3-2024", "/not-there"):
+        result = find(path)
+        assert result is None, (path, result)
+
+@test
+async def methods():
+    server = Server()
+    get_user = Resource()
+    put_user = Resource()
+    post_user = Resource()
+    about = Resource()
+    page = Resource()
+
+    server.add_route("/users/{id}", get_user, methods=("GET", "HEAD"))
+    server.add_route("/users/{id}", put_user, method="PUT")
+    server.add_route("/users/new", post_user, method="POST")
+    server.add_route("/about", about, method="GET")
+    server.add_route("/{page}", page, method="POST")
+
+    server.freeze()
+
+    def find(path, method):
+        match = server._router.find_route(path, method)
+        return None if match is None else match[0].resource
+
+    result = find("/users/alice", "GET")
+    assert result is get_user, result
+
+    result = find("/users/alice", "PUT")
+    assert result is put_user, result
+
+    result = find("/users/new", "GET")
+    assert result is get_user, result
+
+    result = find("/users/new", "POST")
+    assert result is post_user, result
+
+    result = find("/about", "POST")
+    assert result is page, result
+
+    result = find("/users/alice", "DELETE")
+    assert result.allow_header == (b"allow", b"GET, HEAD, PUT"), result.allow_header
+
+    result = find("/users/new", "DELETE")
+    assert result.allow_header == (b"allow", b"POST, GET, HEAD, PUT"), result.allow_header
+
+    result = find("/about/x", "GET")
+    assert result is None, result
+
+    sent = list()
+
+    async def send(message):
+        sent.append(message)
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    server = Server()
+    server.add_route("/a/{x}", Resource(method="GET"))
+    server.add_route("/a/b", Resource(method="POST"))
+    server.add_route("/x", Resource(), method="PUT")
+    server.add_route("/y", Resource(), methods=("GET", "DELETE"))
+
+    server.freeze()
+
+    for method, path in (("PUT", "/x"), ("DELETE", "/y")):
+        await server({"type": "http", "method": method, "path": path, "query_string": b"", "headers": []},
+                     receive, send)
+
+    result = [x["status"] for x in sent if x["type"] == "http.response.start"]
+    assert result == [200, 200], result
+
+    sent.clear()
+
+    await server({"type": "http", "method": "PUT", "path": "/a/b", "query_string": b"", "headers": []},
+                 receive, send)
+
+    result = (sent[0]["status"], dict(sent[0]["headers"])[b"allow"])
+    assert result == (405, b"POST, GET"), result
+
+    server = Server()
+    server.add_route("/about", Resource())
+    server.add_route("/about", Resource(method="POST"))
+
+    with expect_exception(RouteError):
+        server.freeze()
+
+@test
+def hosts():
+    server = Server()
+    main = Resource()
+    alpha = Resource()
+    beta = Resource()
+
+    server.add_route("/", main)
+    server.add_route("/", alpha, host="alpha.example.com")
+    server.add_route("/", beta, host="*.example.com")
+
+    server.freeze()
+
+    def find(host):
+        headers = [] if host is None else [(b"host", host.encode("utf-8"))]
+        scope = {"path": "/", "method": "GET", "headers": headers}
+        match = server._get_router(scope).find_route(scope["path"], scope["method"])
+
+        return match[0].resource
+
+    result = find(None)
+    assert result is main, result
+
+    result = find("localhost:8080")
+    assert result is main, result
+
+    result = find("alpha.example.com")
+    assert result is alpha, result
+
+    result = find("ALPHA.example.com:8080")
+    assert result is alpha, result
+
+    result = find("beta.example.com")
+    assert result is beta, result
+
+    result = find("x.beta.example.com")
+    assert result is beta, result
+
+    result = find("example.com")
+    assert result is main, result
+
+    result = find("[::1]:8080")
+    assert result is main, result
+
+@test
+def mounts():
+    server = Server()
+    api_server = Server()
+    before = Resource()
+    after = Resource()
+
+    server.add_route("/api/status", before)
+    server.mount("/api", api_server)
+    server.add_route("/api/other", after)
+    server.add_route("/apiary", after)
+
+    api_server.add_route("/users/{id}", Resource())
+
+    def find(path):
+        match = server._router.find_route(path, "GET")
+        return None if match is None else match[0].resource
+
+    result = find("/api/status")
+    assert result is before, result
+
+    result = find("/api/other")
+    assert result.server is api_server, result
+
+    result = find("/api")
+    assert result.server is api_server, result
+
+    result = find("/apiary")
+    assert result is after, result
+
+    with expect_exception(RouteError):
+        server.freeze()
+
+    server = Server()
+    server.mount("/api", api_server)
+    server.freeze()
+
+    with expect_exception(RouteError):
+        api_server.add_route("/late", Resource())
+
+    a, b = Server(), Server()
+    a.mount("/b", b)
+    b.mount("/a", a)
+    a.freeze()
+
+    result = (a._frozen, b._frozen)
+    assert result == (True, True), result
+
+@test
+def path_param_types():
+    server = Server()
+    by_id = Resource()
+    by_key = Resource()
+    by_code = Resource()
+    by_name = Resource()
+
+    server.add_route("/items/{id:int}", by_id)
+    server.add_route("/items/{key:uuid}", by_key)
+    server.add_route("/items/{code:re:[a-z]{3}}", by_code)
+    server.add_route("/items/x-{id:int}", by_id)
+    server.add_route("/items/{name:str}", by_name)
+
+    key = "3f2504e0-4f89-11d3-9a0c-0305e82c3301"
+
+    for frozen in (False, True):
+        if frozen:
+            server.freeze()
+
+        def find(path):
+            match = server._router.find_route(path, "GET")
+            return None if match is None else (match[0].resource, match[1])
+
+        result = find("/items/123")
+        assert result == (by_id, {"id": 123}), result
+
+        result = find(f"/items/{key}")
+        assert result == (by_key, {"key": uuid.UUID(key)}), result
+
+        result = find("/items/abc")
+        assert result == (by_code, {"code": "abc"}), result
+
+        result = find("/items/x-7")
+        assert result == (by_id, {"id": 7}), result
+
+        result = find("/items/abcd")
+        assert result == (by_name, {"name": "abcd"}), result
+
+    server = Server()
+    server.add_route("/items/{id:int}", by_id)
+    server.add_route("/items/{number:int}", by_id)
+
+    with expect_exception(RouteError):
+        server.freeze()
+
+    for path in ("/items/{id:float}", "/items/{id", "/items/{1d}"):
+        with expect_exception(RouteError):
+            Server().add_route(path, by_id)
+
+@test
+async def route_hits():
+    server = Server()
+    server.count_route_hits = True
+    server.reorder_routes = True
+    server.reorder_interval = 10
+
+    alpha, beta, gamma, other = Resource(), Resource(), Resource(), Resource()
+
+    server.add_route("/x/a-{id}", alpha)
+    server.add_route("/x/b-{id}", beta)
+    server.add_route("/x/c-{id}.json", gamma)
+    server.add_route("/y/{id:int}", other)
+    server.add_route("/y/{name}", other)
+
+    server.freeze()
+
+    x_node = server._router._root.static_children["x"]
+    y_node = server._router._root.static_children["y"]
+
+    assert x_node.exclusive
+    assert not y_node.exclusive
+
+    sent = list()
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    for path in ["/x/c-1.json"] * 8 + ["/x/b-1"] * 2 + ["/y/z"] * 10:
+        scope = {"type": "http", "method": "GET", "path": path, "query_string": b"", "headers": []}
+        await server(scope, receive, send)
+
+    result = [x.text for x, _ in x_node.dynamic_children]
+    assert result == ["c-{id}.json", "b-{id}", "a-{id}"], result
+
+    result = [x.text for x, _ in y_node.dynamic_children]
+    assert result == ["{id:int}", "{name}"], result
+
+    result = server._router.find_route("/x/a-1", "GET")
+    assert result == (server._router.routes[0], {"id": "1"}), result
+
+    result = server._router.find_route("/y/1", "GET")
+    assert result == (server._router.routes[3], {"id": 1}), result
+
+    result = server.get_route_hits()
+    assert result["/x/c-{id}.json (GET, HEAD, POST) -> Resource()"] == 8, result
+    assert result["/y/{name} (GET, HEAD, POST) -> Resource()"] == 10, result
+
+@test
+def freeze():
+    server = Server()
+    user = Resource()
+    report = Resource()
+
+    server.add_route("/", Resource())
+    server.add_route("/users/{id}", user)
+    server.add_route("/users/{id}/reports/q{quarter}", report)
+    server.add_route("/users/{id}/reports/{name}", report)
+    server.add_route("/files/{name}", Resource())
+    server.add_route("/files/*", Resource())
+
+    server.freeze()
+    server.freeze()
+
+    with expect_exception(RouteError):
+        server.add_route("/late", Resource())
+
+    for host in ("new.example.com", "*.example.org"):
+        with expect_exception(RouteError):
+            server.add_route("/late", Resource(), host=host)
+
+        with expect_exception(RouteError):
+            server.mount("/late", Server(), host=host)
+
+    result = (server._routers_by_host, server._routers_by_domain)
+    assert result == ({}, {}), result
+
+    result = server._router.find_route("/users/alice", "GET")
+    assert result == (server._router.routes[1], {"id": "alice"}), result
+
+    result = server._router.find_route("/users/alice/reports/q3", "GET")
+    assert result == (server._router.routes[2], {"id": "alice", "quarter": "3"}), result
+
+    result = server._router.find_route("/users/alice/reports/x3", "GET")
+    assert result == (server._router.routes[3], {"id": "alice", "name": "x3"}), result
+
+    result = server._router.find_route("/users/alice/reports/", "GET")
+    assert result is None, result
+
+    for shadowed in ("/users/new", "/users/{name}", "/users/x{name}", "/files", "/files/a/b", "/files/*", "/users/{id}"):
+        server = Server()
+        server.add_route("/users/{id}", user)
+        server.add_route("/files/*", user)
+        server.add_route(shadowed, Resource())
+
+        with expect_exception(RouteError):
+            server.freeze()
+
 @test
 async def command():
     # Missing MODULE:SERVER
@@ -144,6 +1164,8 @@ async def client_server():
             response = await client.get(url)
             assert response.status_code == 200, response.status_code
             assert response.text == "main", response.text
+            assert response.headers["cache-control"] == "no-store", response.headers
+            assert response.headers["referrer-policy"] == "no-referrer", response.headers
 
             response = await client.head(url)
             assert response.status_code == 200, response.status_code
@@ -157,6 +1179,7 @@ async def client_server():
             response = await client.get(f"{url}/files/alpha.txt")
             assert response.status_code == 200, response.status_code
             assert response.headers["content-type"].startswith("text/plain"), response.headers["content-type"]
+            assert response.headers["cache-control"] == "no-cache", response.headers
             assert response.text == "alpha", response.text
 
             response = await client.get(f"{url}/files/alpha.txt", headers={"if-none-match": response.headers["etag"]})
@@ -167,18 +1190,118 @@ async def client_server():
             assert response.headers["content-type"].startswith("text/html"), response.headers["content-type"]
             assert "beta" in response.text, response.text
 
+            response = await client.get(f"{url}/files/gamma.js", headers={"accept-encoding": "gzip"})
+            assert response.status_code == 200, response.status_code
+            assert response.headers["content-encoding"] == "gzip", response.headers
+            assert response.headers["content-type"].startswith("text/javascript"), response.headers
+            assert response.text == "gamma", response.text
+
+            gzip_etag = response.headers["etag"]
+
+            response = await client.get(f"{url}/files/gamma.js", headers={"accept-encoding": "identity"})
+            assert "content-encoding" not in response.headers, response.headers
+            assert response.headers["vary"] == "accept-encoding", response.headers
+            assert response.headers["etag"] != gzip_etag, response.headers
+            assert response.text == "gamma", response.text
+
+            response = await client.get(f"{url}/files/gamma.js", headers={"accept-encoding": "gzip",
+                                                                          "if-none-match": gzip_etag})
+            assert response.status_code == 304, response.status_code
+
+            response = await client.get(f"{url}/files/digits.txt", headers={"range": "bytes=2-4"})
+            assert response.status_code == 206, response.status_code
+            assert response.headers["content-range"] == "bytes 2-4/10", response.headers
+            assert response.headers["accept-ranges"] == "bytes", response.headers
+            assert response.headers["cache-control"] == "max-age=60", response.headers
+            assert response.text == "234", response.text
+
+            digits_etag = response.headers["etag"]
+
+            response = await client.get(f"{url}/files/digits.txt", headers={"range": "bytes=-3"})
+            assert response.text == "789", response.text
+
+            response = await client.get(f"{url}/files/digits.txt", headers={"range": "bytes=8-"})
+            assert response.text == "89", response.text
+
+            response = await client.get(f"{url}/files/digits.txt", headers={"range": "bytes=0-1,5-6"})
+            assert response.status_code == 206, response.status_code
+            assert response.headers["content-type"].startswith("multipart/byteranges"), response.headers
+            assert int(response.headers["content-length"]) == len(response.content), response.headers
+            assert "Content-Range: bytes 0-1/10\r\n\r\n01\r\n" in response.text, response.text
+            assert "Content-Range: bytes 5-6/10\r\n\r\n56\r\n" in response.text, response.text
+
+            response = await client.get(f"{url}/files/digits.txt", headers={"range": "bytes=0-1",
+                                                                            "if-range": digits_etag})
+            assert response.status_code == 206, response.status_code
+
+            response = await client.get(f"{url}/files/digits.txt", headers={"range": "bytes=0-1",
+                                                                            "if-range": '"stale"'})
+            assert response.status_code == 200, response.status_code
+            assert response.text == "0123456789", response.text
+
+            response = await client.get(f"{url}/files/digits.txt", headers={"range": "bytes=20-30"})
+            assert response.status_code == 416, response.status_code
+            assert response.headers["content-range"] == "bytes */10", response.headers
+
+            response = await client.get(f"{url}/files/digits.txt", headers={"range": "lines=1-2"})
+            assert response.status_code == 200, response.status_code
+
             response = await client.get(f"{url}/files/not-there")
             assert response.status_code == 404, response.status_code
 
             response = await client.post(f"{url}/json", json={"a": [1, 2, 3]})
             assert response.status_code == 200, response.status_code
+            assert response.headers["content-type"] == "application/json", response.headers["content-type"]
+            assert response.json() == {"a": [1, 2, 3]}, response.json()
 
-            response = await client.get(f"{url}/post-only")
+            response = await client.get(f"{url}/large", headers={"accept-encoding": "gzip"})
+            assert response.status_code == 200, response.status_code
+            assert response.headers["content-encoding"] == "gzip", response.headers
+            assert response.text == "large " * 1000, response.text
+
+            response = await client.post(f"{url}/json", content=b"{not json")
             assert response.status_code == 400, response.status_code
 
+            response = await client.get(f"{url}/post-only")
+            assert response.status_code == 405, response.status_code
+            assert response.headers["allow"] == "POST", response.headers["allow"]
+
             response = await client.get(f"{url}/required-param")
             assert response.status_code == 400, response.status_code
 
+            async def upload_chunks():
+                for i in range(64):
+                    yield b"x" * 65536
+
+            response = await client.post(f"{url}/upload", content=upload_chunks())
+            assert response.status_code == 200, response.status_code
+            assert response.text == str(64 * 65536), response.text
+
+            response = await client.post(f"{url}/small-upload", content=b"x" * 10)
+            assert response.status_code == 200, response.status_code
+
+            response = await client.post(f"{url}/small-upload", content=upload_chunks())
+            assert response.status_code == 413, response.status_code
+
+            data = {"title": "Hello"}
+            files = {"upload": ("big.bin", b"x" * 300_000, "application/octet-stream")}
+            digest = hashlib.sha256(b"x" * 300_000).hexdigest()[:8]
+
+            response = await client.post(f"{url}/form", data=data, files=files)
+            assert response.status_code == 200, response.status_code
+            assert response.text == f"title=Hello,upload:big.bin:300000:{digest}", response.text
+
+            response = await client.get(f"{url}/stream")
+            assert response.status_code == 200, response.status_code
+            assert response.text == "chunk 0\nchunk 1\nchunk 2\ndone", response.text
+
+            response = await client.get(f"{url}/api/hello")
+            assert response.status_code == 200, response.status_code
+            assert response.text == "hello /hello", response.text
+
+            response = await client.get(f"{url}/api/not-there")
+            assert response.status_code == 404, response.status_code
+
 def main():
     from . import tests
 